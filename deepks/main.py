@@ -14,7 +14,7 @@ def main_cli(args=None):
                 description="A program to generate accurate energy functionals.")
     parser.add_argument("command", 
                         help="specify the sub-command to run, possible choices: "
-                             "train, test, scf, stats, iterate")
+                             "train, test, scf, stats, pack, iterate")
     parser.add_argument("args", nargs=argparse.REMAINDER,
                         help="arguments to be passed to the sub-command")
 
@@ -29,6 +29,8 @@ def main_cli(args=None):
         sub_cli = scf_cli
     elif args.command.upper() == "STATS":
         sub_cli = stats_cli
+    elif args.command.upper() == "PACK":
+        sub_cli = pack_cli
     elif args.command.upper().startswith("ITER"):
         sub_cli = iter_cli
     else:
@@ -58,6 +60,8 @@ def train_cli(args=None):
                         help='use specified seed in initialization and training')
     parser.add_argument("-D", "--device",
                         help="device name used in training the model")    
+    parser.add_argument("-N", "--nproc", type=int,
+                        help="number of local processes used in data parallel training")
     args = parser.parse_args(args)
     
     if hasattr(args, "input"):
@@ -83,13 +87,17 @@ def test_cli(args=None):
     parser.add_argument("-m", "--model-file", type=str, nargs='+',
                         help="the dumped model file to test")
     parser.add_argument("-o", "--output-prefix", type=str,
-                        help=r"the prefix of output file, would wite into file %%prefix.%%sysidx.out")
+                        help=r"the prefix of output file, would wite into file %%prefix.%%sysidx.out "
+                              r"in the folder of each model (and %%prefix.ens.* for ensembles, "
+                              r"in the common folder of all models)")
     parser.add_argument("-E", "--e-name", type=str,
                         help="the name of energy file to be read (no .npy extension)")
     parser.add_argument("-D", "--d-name", type=str, nargs="+",
                         help="the name of descriptor file(s) to be read (no .npy extension)")
     parser.add_argument("-G", "--group", action='store_true',
                         help="group test results for all systems")
+    parser.add_argument("--no-ensemble", dest="ensemble", action="store_false",
+                        help="test multiple models one by one instead of in one batched pass")
     args = parser.parse_args(args)
 
     if hasattr(args, "input"):
@@ -135,6 +143,14 @@ def scf_cli(args=None):
                         help="basis set used to project dm, must match with model")   
     parser.add_argument("-D", "--device",
                         help="device name used in nn model inference")               
+    parser.add_argument("-W", "--workers", type=int,
+                        help="number of processes used to solve frames in parallel")
+    parser.add_argument("-R", "--resume", action='store_true',
+                        help="skip frames already finished in the dump dir by a previous run")
+    parser.add_argument("--warm-start", action='store_true',
+                        help="start scf from the converged dm of previous frame with same atoms")
+    parser.add_argument("-T", "--timing-file",
+                        help="file to save timings of each frame and system, csv or json")
     group0 = parser.add_mutually_exclusive_group()   
     group0.add_argument("-G", "--group", action='store_true', dest="group",
                         help="group results for all systems, only works for same number of atoms")
@@ -152,6 +168,13 @@ def scf_cli(args=None):
                         help="subspace dimension used in diis mixing")
     parser.add_argument("--scf-level-shift", type=float,
                         help="level shift used in scf calculation")
+    parser.add_argument("--scf-screen-tol", type=float,
+                        help="drop ao blocks whose overlap with projectors is below it")
+    parser.add_argument("--scf-net-dtype", type=str,
+                        help="evaluate the network in lower precision, like float32, "
+                             "if it agrees with float64 on the first converged frame")
+    parser.add_argument("--scf-net-tol", type=float,
+                        help="max deviation of energy and potential allowed for --scf-net-dtype")
 
     args = parser.parse_args(args)
 
@@ -217,6 +240,29 @@ def stats_cli(args=None):
     print_stats(**argdict)
 
 
+def pack_cli(args=None):
+    parser = argparse.ArgumentParser(
+                prog="deepks pack",
+                description="Pack data of many systems into one sharded dataset for training.",
+                argument_default=argparse.SUPPRESS)
+    parser.add_argument("systems", nargs="+",
+                        help="paths to the folders of system data to be packed")
+    parser.add_argument("-o", "--out-path",
+                        help="folder of the packed dataset, default: data.pack")
+    parser.add_argument("-F", "--fields", nargs="+",
+                        help="names of the data files to be packed (no .npy extension)")
+    parser.add_argument("--float32", action="store_true",
+                        help="save descriptors and their gradients in single precision")
+    parser.add_argument("--shard-size", type=float,
+                        help="approximate size of each shard in MB, default: 1024")
+    parser.add_argument("-D", "--d-name",
+                        help="name of descriptor file, used to infer meta if no system.raw")
+    args = parser.parse_args(args)
+
+    from deepks.model.pack import main
+    main(**vars(args))
+
+
 def iter_cli(args=None):
     parser = argparse.ArgumentParser(
                 prog="deepks iterate",
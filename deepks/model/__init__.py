@@ -1,6 +1,7 @@
 __all__ = [
     "model",
     "reader",
+    "pack",
     "train",
     "test",
 ]
@@ -10,6 +11,9 @@ def __getattr__(name):
     if name == "CorrNet":
         from .model import CorrNet
         return CorrNet
+    if name == "CorrNetEnsemble":
+        from .model import CorrNetEnsemble
+        return CorrNetEnsemble
     if name in __all__:
         return import_module("." + name, __name__)
     raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,11 +1,14 @@
 import math
+import json
 import inspect
+import zipfile
 import numpy as np
 import torch
 import torch.nn as nn 
 from torch.nn import functional as F
+from typing import List, Optional
 from deepks.utils import load_basis, get_shell_sec
-from deepks.utils import load_elem_table, save_elem_table
+from deepks.utils import load_elem_table
 
 SCALE_EPS = 1e-8
 
@@ -144,7 +147,7 @@ class TraceEmbedding(nn.Module):
         self.shell_sec = shell_sec
         self.ndesc = len(shell_sec)
     
-    def forward(self, x):
+    def forward(self, x, mask=None):
         x_shells = x.split(self.shell_sec, dim=-1)
         tr_shells = [sx.sum(-1, keepdim=True) for sx in x_shells]
         return torch.cat(tr_shells, dim=-1)
@@ -174,10 +177,11 @@ class ThermalEmbedding(nn.Module):
         self.register_buffer('running_var', torch.ones(len(shell_sec)))
         self.register_buffer('num_batches_tracked', torch.tensor(0, dtype=torch.long))
 
-    def forward(self, x):
+    def forward(self, x, mask=None):
         x_padded = pad_masked(x, self.shell_mask, 0.) # shape: [n, a, l, m]
         if self.training:
-            self.update_running_stats(x_padded)
+            # padded atoms (mask is False) are excluded from the stats
+            self.update_running_stats(x_padded if mask is None else x_padded[mask.bool()])
         nx_padded = ((x_padded - self.running_mean.unsqueeze(-1)) 
                     / (self.running_var.sqrt().unsqueeze(-1) + SCALE_EPS)
                     * self.shell_mask.to(x_padded))
@@ -262,16 +266,42 @@ class CorrNet(nn.Module):
             torch.tensor(0, dtype=torch.float64), 
             requires_grad=False)
     
-    def forward(self, x):
+    def forward(self, x, mask=None):
         # x: nframes x natom x nfeature
+        # mask: nframes x natom, False for padded atoms
+        x, l = self.embed(x, mask)
+        return self.fit(x, l, mask)
+
+    def embed(self, x, mask=None):
+        # normalization, embedding and prefitting linear term of each atom
         x = (x - self.input_shift) / (self.input_scale + SCALE_EPS)
         l = self.linear(x)
         if self.embedder is not None:
-            x = self.embedder(x)
+            x = self.embedder(x, mask)
+        return x, l
+
+    def fit(self, x, l, mask=None):
+        # x, l: outputs of self.embed
         y = self.densenet(x)
         y = y / self.output_scale + l
+        if mask is not None:
+            y = y * mask.unsqueeze(-1).to(y)
         e = y.sum(-2) + self.energy_const
         return e
+
+    def has_frozen_embedding(self):
+        """whether outputs of `embed` stay fixed when training the model"""
+        if self.embedder is None:
+            return False
+        if any(p.requires_grad for p in self.embedder.parameters()):
+            return False
+        if any(p.requires_grad for p in self.linear.parameters()):
+            return False
+        embd = self.embedder
+        if isinstance(embd, ThermalEmbedding): # running stats may still be updated
+            return (embd.momentum is None 
+                    and embd.num_batches_tracked.item() >= embd.max_memory)
+        return True
     
     def get_elem_const(self, elems):
         if self.elem_dict is None:
@@ -306,21 +336,15 @@ class CorrNet(nn.Module):
     def save(self, filename, **extra_info):
         torch.save(self.save_dict(**extra_info), filename)
 
-    def compile(self, set_eval=True, **kwargs):
-        old_mode = self.training
-        if set_eval:
-            self.eval()
-        smodel = torch.jit.trace(
-            self.forward, 
-            torch.empty((2, 2, self.input_dim)),
-            **kwargs)
-        self.train(old_mode)
+    def compile(self, check=True, rtol=1e-8):
+        """return a scripted inference model, see `ScriptCorrNet`"""
+        smodel = torch.jit.script(ScriptCorrNet(self))
+        if check:
+            smodel.check(self, rtol=rtol)
         return smodel
 
     def compile_save(self, filename, **kwargs):
         torch.jit.save(self.compile(**kwargs), filename)
-        if self.elem_table is not None:
-            save_elem_table(filename+".elemtab", self.elem_table)
     
     @staticmethod
     def load_dict(checkpoint, strict=False):
@@ -335,8 +359,335 @@ class CorrNet(nn.Module):
 
     @staticmethod
     def load(filename, strict=False):
-        try:
-            return torch.jit.load(filename)
-        except RuntimeError:
-            checkpoint = torch.load(filename, map_location="cpu")
-            return CorrNet.load_dict(checkpoint, strict=strict)
+        if is_script_file(filename):
+            return load_script(filename)
+        checkpoint = torch.load(filename, map_location="cpu")
+        return CorrNet.load_dict(checkpoint, strict=strict)
+
+
+def is_script_file(filename):
+    """whether the file is a TorchScript archive rather than a checkpoint"""
+    if not zipfile.is_zipfile(filename):
+        return False
+    with zipfile.ZipFile(filename) as zf:
+        return any(name.split("/")[1:2] == ["code"] for name in zf.namelist())
+
+
+def load_script(filename):
+    smodel = torch.jit.load(filename, map_location="cpu")
+    if hasattr(smodel, "proj_basis"): # exported by CorrNet.compile
+        smodel._pbas = json.loads(smodel.proj_basis)
+        smodel.elem_table = (None if not smodel.elem_list else 
+            (np.array(smodel.elem_list), np.array(smodel.elem_const)))
+    return smodel
+
+
+def actv_name(fn):
+    """inverse of parse_actv_fn, used when the model is scripted"""
+    if isinstance(fn, str):
+        return fn.lower()
+    for name in ("sigmoid", "tanh", "relu", "softplus", "silu", "gelu", "mygelu"):
+        if parse_actv_fn(name) is fn:
+            return name
+    raise ValueError(f"activation function {fn} can not be scripted")
+
+
+class ScriptCorrNet(nn.Module):
+    """Inference form of CorrNet, to be compiled by `torch.jit.script`.
+
+    Works on inputs of any number of frames and atoms. Input normalization
+    and the prefitting linear term are folded into one affine layer in front,
+    together with the trace embedding and the first dense layer when they are
+    linear, and the output scale is folded into the last layer.
+    Elem table and projection basis are kept as attributes.
+    """
+    residual: List[bool]
+    elem_list: List[int]
+    elem_const: List[float]
+    
+    def __init__(self, model):
+        super().__init__()
+        inv_scale = 1. / (model.input_scale.detach() + SCALE_EPS)
+        shift = model.input_shift.detach()
+        lin_w = model.linear.weight.detach()[0] * inv_scale
+        lin_b = model.linear.bias.detach() - shift @ lin_w
+        layers = [(l.weight.detach().clone(), l.bias.detach().clone()) 
+                  for l in model.densenet.layers]
+        use_resnet = model.densenet.use_resnet
+        residual = [use_resnet and w.shape[0] == w.shape[1] for w, b in layers]
+        if model.densenet.dts is not None:
+            raise ValueError("densenet with dts can not be scripted")
+        self.actv = actv_name(model._init_args["actv_fn"])
+        # fold output scale into the last layer if it has no residual
+        self.out_scale = model.output_scale.item()
+        if not residual[-1]:
+            layers[-1] = (layers[-1][0] / self.out_scale, layers[-1][1] / self.out_scale)
+            self.out_scale = 1.
+        self.energy_const = model.energy_const.item()
+        # embedding; normalized input is kept only if embedding is non-linear
+        embedder = model.embedder
+        self.embd_type = ("none" if embedder is None else
+                          "trace" if isinstance(embedder, TraceEmbedding) else
+                          "thermal")
+        self.register_buffer("input_shift", shift.clone())
+        self.register_buffer("inv_scale", inv_scale)
+        self.register_buffer("shell_mask", torch.zeros(0, 0, dtype=bool))
+        self.register_buffer("embd_mask", torch.zeros(0, 0, dtype=bool))
+        self.register_buffer("running_mean", torch.zeros(0).double())
+        self.register_buffer("running_std", torch.zeros(0).double())
+        self.register_buffer("neg_beta", torch.zeros(0, 0).double())
+        self.first_folded = False
+        if self.embd_type == "thermal":
+            self.shell_mask = embedder.shell_mask.clone()
+            self.embd_mask = embedder.embd_mask.clone()
+            self.running_mean = embedder.running_mean.detach().clone()
+            self.running_std = embedder.running_var.detach().sqrt() + SCALE_EPS
+            self.neg_beta = -embedder.beta.detach().clone()
+            front_w, front_b = lin_w[:, None], lin_b
+        else:
+            # normalization (and trace) as an affine map: x @ desc_w + desc_b
+            desc_w = torch.diag(inv_scale)
+            if self.embd_type == "trace":
+                desc_w = torch.block_diag(*[torch.ones(n, 1).to(desc_w) 
+                                            for n in embedder.shell_sec])
+                desc_w = inv_scale[:, None] * desc_w
+            desc_b = - shift @ desc_w
+            if not residual[0]:
+                w1, b1 = layers.pop(0)
+                desc_w, desc_b = desc_w @ w1.T, desc_b @ w1.T + b1
+                self.first_folded = True
+            front_w = torch.cat([desc_w, lin_w[:, None]], dim=1)
+            front_b = torch.cat([desc_b, lin_b])
+        self.front = nn.Linear(*front_w.shape).double()
+        self.front.weight.data = front_w.T.contiguous()
+        self.front.bias.data = front_b.clone()
+        self.layers = nn.ModuleList()
+        for w, b in layers:
+            layer = nn.Linear(w.shape[1], w.shape[0]).double()
+            layer.weight.data, layer.bias.data = w, b
+            self.layers.append(layer)
+        nlayer = len(model.densenet.layers)
+        self.residual = residual[nlayer-len(layers):]
+        self.front_actv = self.first_folded and nlayer > 1
+        # attributes to make the exported file self-contained
+        self.proj_basis = json.dumps(model._pbas)
+        elem_table = model.elem_table
+        self.elem_list = ([] if elem_table is None 
+                          else [int(e) for e in elem_table[0]])
+        self.elem_const = ([] if elem_table is None 
+                           else [float(c) for c in elem_table[1]])
+
+    def forward(self, x, mask: Optional[torch.Tensor] = None):
+        # x: nframes x natom x nfeature, or natom x nfeature
+        # mask: nframes x natom, False for padded atoms
+        z = self.front(x)
+        l = z[..., -1:]
+        if self.embd_type == "thermal":
+            h = self.thermal_embed((x - self.input_shift) * self.inv_scale)
+        else:
+            h = z[..., :-1]
+            if self.front_actv:
+                h = self.activate(h)
+        nlayer = len(self.residual)
+        for i, layer in enumerate(self.layers):
+            tmp = layer(h)
+            if i < nlayer - 1:
+                tmp = self.activate(tmp)
+            if self.residual[i]:
+                h = h + tmp
+            else:
+                h = tmp
+        y = h / self.out_scale + l
+        if mask is not None:
+            y = y * mask.unsqueeze(-1).to(y)
+        return y.sum(-2) + self.energy_const
+
+    def activate(self, x):
+        if self.actv == "sigmoid":
+            return torch.sigmoid(x)
+        if self.actv == "tanh":
+            return torch.tanh(x)
+        if self.actv == "relu":
+            return torch.relu(x)
+        if self.actv == "softplus":
+            return F.softplus(x)
+        if self.actv == "silu":
+            return F.silu(x)
+        if self.actv == "mygelu":
+            return 0.5 * x * (1 + torch.tanh(math.sqrt(2 / math.pi) * (x + 0.044715 * torch.pow(x, 3))))
+        return F.gelu(x)
+
+    def thermal_embed(self, x):
+        # same as ThermalEmbedding.forward in eval mode
+        x_padded = x.new_zeros(x.shape[:-1] + self.shell_mask.shape)
+        x_padded = x_padded.masked_scatter(self.shell_mask, x) # shape: [n, a, l, m]
+        fmask = self.shell_mask.to(x_padded)
+        nx_padded = ((x_padded - self.running_mean.unsqueeze(-1)) 
+                    / self.running_std.unsqueeze(-1) * fmask)
+        logits = nx_padded.unsqueeze(-1) * self.neg_beta.unsqueeze(-2)
+        exps = torch.exp(logits - logits.max(dim=-2, keepdim=True)[0])
+        mexps = exps * fmask.unsqueeze(-1)
+        weight = mexps / mexps.sum(dim=-2, keepdim=True).clamp(1e-10)
+        desc_padded = (x_padded.unsqueeze(-1) * weight).sum(-2)
+        ndesc = int(self.embd_mask.sum())
+        return torch.masked_select(desc_padded, self.embd_mask).reshape(
+            list(x.shape[:-1]) + [ndesc])
+
+    @torch.jit.export
+    def get_elem_const(self, elems: List[int]) -> float:
+        const = 0.
+        if len(self.elem_list) == 0: # no elem table
+            return const
+        for ee in elems:
+            const += self.elem_const[self.elem_list.index(ee)]
+        return const
+
+    @torch.jit.ignore
+    def check(self, model, rtol=1e-8):
+        """compare energies and gradients with the eager model"""
+        old_mode = model.training
+        model.eval()
+        gen = torch.Generator().manual_seed(0)
+        scale = model.input_scale.detach().abs() + 1
+        for shape in [(3, 2), (1, 5), (4,)]:
+            x = torch.randn(*shape, model.input_dim, generator=gen, dtype=torch.float64)
+            x = x.to(scale) * scale + model.input_shift.detach()
+            x1 = x.clone().requires_grad_(True)
+            x2 = x.clone().requires_grad_(True)
+            e1, e2 = model(x1), self(x2)
+            [g1] = torch.autograd.grad(e1.sum(), x1)
+            [g2] = torch.autograd.grad(e2.sum(), x2)
+            for ref, val in [(e1, e2), (g1, g2)]:
+                err = (ref - val).abs().max().item()
+                if not err <= rtol * (1 + ref.abs().max().item()):
+                    model.train(old_mode)
+                    raise RuntimeError(f"scripted model differs from eager one by {err:.2e}")
+        model.train(old_mode)
+
+
+class CorrNetEnsemble(nn.Module):
+    """Evaluate several compatible CorrNets in one batched forward pass.
+
+    Parameters of members are stacked along a leading model axis, so members
+    must share the network sizes, activation, embedding and elem table.
+    Only used for inference; running stats of embeddings are never updated.
+    """
+
+    def __init__(self, models):
+        super().__init__()
+        models = list(models)
+        self.check_compatible(models)
+        ref = models[0]
+        self.nmodel = len(models)
+        self.input_dim = ref.input_dim
+        self.shell_sec = ref.shell_sec
+        self.elem_table = ref.elem_table
+        self.elem_dict = ref.elem_dict
+        self.actv_fn = ref.densenet.actv_fn
+        self.use_resnet = ref.densenet.use_resnet
+        stack = lambda get: torch.stack([get(m).detach() for m in models])
+        # normalization and prefitting
+        self.register_buffer("input_shift", stack(lambda m: m.input_shift)) # [M, d]
+        self.register_buffer("input_scale", stack(lambda m: m.input_scale)) # [M, d]
+        self.register_buffer("lin_weight", stack(lambda m: m.linear.weight[0])) # [M, d]
+        self.register_buffer("lin_bias", stack(lambda m: m.linear.bias)) # [M, 1]
+        self.register_buffer("output_scale", stack(lambda m: m.output_scale)) # [M]
+        self.register_buffer("energy_const", stack(lambda m: m.energy_const)) # [M]
+        # embedding
+        self.embedder = None
+        if isinstance(ref.embedder, TraceEmbedding):
+            self.embedder = ref.embedder # no parameters
+        elif isinstance(ref.embedder, ThermalEmbedding):
+            self.embedder = self.thermal_embed
+            self.register_buffer("shell_mask", ref.embedder.shell_mask.clone(), False)
+            self.register_buffer("embd_mask", ref.embedder.embd_mask.clone(), False)
+            self.register_buffer("beta", stack(lambda m: m.embedder.beta)) # [M, l, p]
+            self.register_buffer("running_mean", stack(lambda m: m.embedder.running_mean))
+            self.register_buffer("running_var", stack(lambda m: m.embedder.running_var))
+        # fitting net
+        self.nlayer = len(ref.densenet.layers)
+        for i in range(self.nlayer):
+            self.register_buffer(f"weight_{i}", stack(lambda m: m.densenet.layers[i].weight))
+            self.register_buffer(f"bias_{i}", stack(lambda m: m.densenet.layers[i].bias))
+
+    @staticmethod
+    def check_compatible(models):
+        if not models:
+            raise ValueError("no model is given for the ensemble")
+        if not all(isinstance(m, CorrNet) for m in models):
+            raise ValueError("ensemble only supports (non-scripted) CorrNet models")
+        def signature(m):
+            embd = m.embedder
+            return (m.input_dim, m.shell_sec,
+                    [tuple(l.weight.shape) for l in m.densenet.layers],
+                    m._init_args["actv_fn"], m.densenet.use_resnet, 
+                    m.densenet.dts is None, type(embd), 
+                    getattr(embd, "embd_sizes", None))
+        ref = signature(models[0])
+        for m in models[1:]:
+            if signature(m) != ref:
+                raise ValueError("models of the ensemble have different structures")
+        elem_tables = [m.elem_table for m in models]
+        if any(et is None for et in elem_tables):
+            if not all(et is None for et in elem_tables):
+                raise ValueError("models of the ensemble have different elem tables")
+        elif not all(np.array_equal(et[0], elem_tables[0][0]) 
+                     and np.allclose(et[1], elem_tables[0][1]) for et in elem_tables):
+            raise ValueError("models of the ensemble have different elem tables")
+
+    def forward(self, x, mask=None):
+        # x: nframes x natom x nfeature, shared by all members
+        # return: nmodel x nframes x 1
+        pshape = (self.nmodel,) + (1,) * (x.ndim - 1) + (-1,)
+        x = (x - self.input_shift.view(pshape)) / (self.input_scale.view(pshape) + SCALE_EPS)
+        l = (x * self.lin_weight.view(pshape)).sum(-1, keepdim=True) + self.lin_bias.view(pshape)
+        if self.embedder is not None:
+            x = self.embedder(x)
+        y = self.dense(x)
+        y = y / self.output_scale.view(pshape) + l
+        if mask is not None:
+            y = y * mask.unsqueeze(-1).to(y)
+        return y.sum(-2) + self.energy_const.view(pshape[:-1])
+
+    def predict(self, x, mask=None):
+        """return energies of each member, their mean and std"""
+        e = self(x, mask)
+        return e, e.mean(0), e.std(0, unbiased=False)
+
+    def thermal_embed(self, x):
+        # same as ThermalEmbedding.forward in eval mode, with a leading model axis
+        pshape = (self.nmodel,) + (1,) * (x.ndim - 2)
+        x_padded = pad_masked(x, self.shell_mask, 0.) # shape: [M, n, a, l, m]
+        nx_padded = ((x_padded - self.running_mean.view(*pshape, -1, 1)) 
+                    / (self.running_var.sqrt().view(*pshape, -1, 1) + SCALE_EPS)
+                    * self.shell_mask.to(x_padded))
+        beta = self.beta.view(*pshape, *self.beta.shape[1:])
+        weight = masked_softmax(
+            nx_padded.unsqueeze(-1) * -beta.unsqueeze(-2),
+            self.shell_mask.unsqueeze(-1), dim=-2)
+        desc_padded = torch.einsum("...m,...mp->...p", x_padded, weight)
+        return unpad_masked(desc_padded, self.embd_mask)
+
+    def dense(self, x):
+        # same as DenseNet.forward, using batched matmul over members
+        shape = x.shape
+        x = x.reshape(self.nmodel, -1, shape[-1])
+        for i in range(self.nlayer):
+            weight, bias = getattr(self, f"weight_{i}"), getattr(self, f"bias_{i}")
+            tmp = torch.baddbmm(bias.unsqueeze(1), x, weight.transpose(1, 2))
+            if i < self.nlayer - 1:
+                tmp = self.actv_fn(tmp)
+            if self.use_resnet and weight.shape[1] == weight.shape[2]:
+                x = x + tmp
+            else:
+                x = tmp
+        return x.reshape(*shape[:-1], -1)
+
+    def get_elem_const(self, elems):
+        if self.elem_dict is None:
+            return 0.
+        return sum(self.elem_dict[ee] for ee in elems)
+
+    @staticmethod
+    def load(filenames, strict=False):
+        return CorrNetEnsemble([CorrNet.load(f, strict=strict) for f in filenames])
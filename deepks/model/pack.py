@@ -0,0 +1,139 @@
+import os
+import sys
+import numpy as np
+try:
+    import deepks
+except ImportError as e:
+    sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../../")
+from deepks.utils import load_dirs
+
+
+# a packed dataset is a folder containing one index file and several shards.
+# each shard is a flat binary file holding arrays of consecutive systems.
+PACK_INDEX = "index.npz"
+SHARD_NAME = "shard.{:03d}.bin"
+ALIGN = 64
+
+DEFAULT_FIELDS = ["l_e_delta", "dm_eig", "l_f_delta", "grad_vx", "eg_base",
+                  "grad_veg", "grad_ldv", "conv", "atom"]
+# descriptor and gradient fields, can be saved in single precision
+FLOAT32_FIELDS = ["dm_eig", "grad_vx", "grad_veg", "grad_ldv"]
+
+
+def is_pack(path):
+    return os.path.isfile(os.path.join(path, PACK_INDEX))
+
+
+def load_sys_meta(path, d_name="dm_eig"):
+    try:
+        sys_meta = np.loadtxt(os.path.join(path, 'system.raw'), dtype=int).reshape([-1])
+        return sys_meta[0], sys_meta[-1]
+    except:
+        sys_shape = np.load(os.path.join(path, f"{d_name}.npy"), mmap_mode="r").shape
+        assert len(sys_shape) == 3, \
+            f"{d_name} has to be an order-3 array with shape [nframes, natom, nproj]"
+        return sys_shape[1], sys_shape[2]
+
+
+class DataPack(object):
+    """Read-only packed dataset. Only the index and the used shards are opened."""
+    def __init__(self, path):
+        self.path = path
+        with np.load(os.path.join(path, PACK_INDEX)) as index:
+            self.index = {k: index[k] for k in index.files}
+        self.names = self.index["names"]
+        self.nsystems = len(self.names)
+        self.fields = list(self.index["fields"])
+        self.dtypes = dict(zip(self.fields, self.index["dtypes"]))
+        self.shards = {}
+
+    def get_meta(self, isys):
+        return self.index["natm"][isys], self.index["nproj"][isys]
+
+    def has_field(self, isys, field):
+        return field in self.fields and self.index[f"size.{field}"][isys] >= 0
+
+    def get_array(self, isys, field):
+        """return flat array of given field, as a copy-on-write memory map"""
+        dtype = np.dtype(self.dtypes[field])
+        offset = self.index[f"offset.{field}"][isys]
+        size = self.index[f"size.{field}"][isys]
+        buf = self.get_shard(self.index["shard"][isys])
+        return buf[offset : offset + size * dtype.itemsize].view(dtype)
+
+    def get_shard(self, ishard):
+        if ishard not in self.shards:
+            self.shards[ishard] = np.memmap(
+                os.path.join(self.path, SHARD_NAME.format(ishard)),
+                dtype=np.uint8, mode="c")
+        return self.shards[ishard]
+
+
+def pack_systems(systems, out_path, fields=None, float32=False,
+                 shard_size=1024, d_name="dm_eig"):
+    """pack arrays of all systems into shards of about `shard_size` MB"""
+    if fields is None:
+        fields = DEFAULT_FIELDS
+    f32_fields = FLOAT32_FIELDS if float32 else []
+    nsys = len(systems)
+    os.makedirs(out_path, exist_ok=True)
+    meta = {k: np.zeros(nsys, dtype=int) for k in ("natm", "nproj", "shard")}
+    offsets = {fd: np.full(nsys, -1, dtype=int) for fd in fields}
+    sizes = {fd: np.full(nsys, -1, dtype=int) for fd in fields}
+    dtypes = {}
+    ishard, pos = 0, 0
+    fshard = open(os.path.join(out_path, SHARD_NAME.format(ishard)), "wb")
+    try:
+        for isys, path in enumerate(systems):
+            if pos >= shard_size * 2**20:
+                fshard.close()
+                ishard, pos = ishard + 1, 0
+                fshard = open(os.path.join(out_path, SHARD_NAME.format(ishard)), "wb")
+            meta["natm"][isys], meta["nproj"][isys] = load_sys_meta(path, d_name)
+            meta["shard"][isys] = ishard
+            for fd in fields:
+                fpath = os.path.join(path, f"{fd}.npy")
+                if not os.path.exists(fpath):
+                    continue
+                data = np.load(fpath)
+                if fd not in dtypes:
+                    dtypes[fd] = (data.dtype if data.dtype.kind != "f"
+                                  else np.float32 if fd in f32_fields
+                                  else np.float64)
+                data = np.ascontiguousarray(data, dtype=dtypes[fd])
+                pad = -pos % ALIGN
+                fshard.write(bytes(pad))
+                offsets[fd][isys], sizes[fd][isys] = pos + pad, data.size
+                fshard.write(data.tobytes())
+                pos += pad + data.nbytes
+    finally:
+        fshard.close()
+    fields = [fd for fd in fields if fd in dtypes]
+    index = dict(
+        names=np.array(systems, dtype=str),
+        fields=np.array(fields, dtype=str),
+        dtypes=np.array([np.dtype(dtypes[fd]).str for fd in fields], dtype=str),
+        **meta,
+        **{f"offset.{fd}": offsets[fd] for fd in fields},
+        **{f"size.{fd}": sizes[fd] for fd in fields})
+    # write index at last, so an unfinished pack is never opened
+    tmp_path = os.path.join(out_path, "index.tmp.npz")
+    np.savez(tmp_path, **index)
+    os.replace(tmp_path, os.path.join(out_path, PACK_INDEX))
+    return ishard + 1
+
+
+def main(systems, out_path="data.pack", fields=None,
+         float32=False, shard_size=1024, d_name="dm_eig"):
+    systems = load_dirs(systems)
+    systems = [p for p in systems if not is_pack(p)]
+    if not systems:
+        raise RuntimeError("No system is avaliable")
+    nshard = pack_systems(systems, out_path, fields=fields, float32=float32,
+                          shard_size=shard_size, d_name=d_name)
+    print(f"# pack {len(systems)} systems into {nshard} shard(s) in {out_path}")
+
+
+if __name__ == "__main__":
+    from deepks.main import pack_cli as cli
+    cli()
@@ -1,6 +1,12 @@
 import os,time,sys
+import functools
+import queue
+import threading
+from collections import defaultdict, OrderedDict
 import numpy as np
 import torch
+import torch.distributed as dist
+from deepks.model.pack import DataPack, is_pack
 
 
 def concat_batch(tdicts, dim=0):
@@ -11,6 +17,72 @@ def concat_batch(tdicts, dim=0):
         for k in keys
     }
 
+def pad_concat_batch(tdicts):
+    """concat batches of different atom numbers along frames, zero padded
+    
+    a bool mask of shape [nframes, natom] marks the real (not padded) atoms.
+    if forces are present, `fmask` of shape [nframes, natom_raw] does the same
+    for the raw atoms of forces, which differ from natom with ghost atoms.
+    """
+    keys = tdicts[0].keys()
+    assert all(d.keys() == keys for d in tdicts)
+    akey, fkey = atom_key(keys), force_key(keys)
+    shapes = {k: [d[k].shape for d in tdicts] for k in keys}
+    out = {k: tdicts[0][k].new_zeros(padded_shape(shapes[k])) for k in keys}
+    out["mask"] = torch.zeros(out[akey].shape[:2], dtype=bool)
+    if fkey is not None:
+        out["fmask"] = torch.zeros(out[fkey].shape[:2], dtype=bool)
+    start = 0
+    for d in tdicts:
+        nf = d[akey].shape[0]
+        for k in keys:
+            out[k][padded_slice(start, d[k].shape)] = d[k]
+        out["mask"][start:start+nf, :d[akey].shape[1]] = True
+        if fkey is not None:
+            out["fmask"][start:start+nf, :d[fkey].shape[1]] = True
+        start += nf
+    return out
+
+def atom_key(keys):
+    # per atom data, descriptors or cached embedding of them
+    return "eig" if "eig" in keys else "feat"
+
+def force_key(keys):
+    # per raw atom data of forces, None if forces are not loaded
+    return next((k for k in ("lb_f", "gvx") if k in keys), None)
+
+MASK_KEYS = ("mask", "fmask")
+
+def padded_shape(shapes):
+    # frames are concatenated and other dims are padded to the max
+    return (sum(s[0] for s in shapes), *map(int, np.max([s[1:] for s in shapes], axis=0)))
+
+def padded_slice(start, shape):
+    return (slice(start, start+shape[0]), *(slice(0, n) for n in shape[1:]))
+
+def get_moments(data):
+    """count, mean and sum of squared deviations along the first axis"""
+    mean = data.mean(0)
+    return np.full_like(mean, data.shape[0]), mean, ((data - mean) ** 2).sum(0)
+
+def merge_moments(mom1, mom2):
+    """combine moments of two parts of data (Chan et al.)"""
+    n1, mean1, m2_1 = mom1
+    n2, mean2, m2_2 = mom2
+    count = n1 + n2
+    delta = mean2 - mean1
+    mean = mean1 + delta * (n2 / count)
+    m2 = m2_1 + m2_2 + delta ** 2 * (n1 * n2 / count)
+    return count, mean, m2
+
+def all_gather(obj):
+    """gather a python object from all processes, in the order of ranks"""
+    if not (dist.is_available() and dist.is_initialized()):
+        return [obj]
+    obj_list = [None] * dist.get_world_size()
+    dist.all_gather_object(obj_list, obj)
+    return obj_list
+
 def split_batch(tdict, size, dim=0):
     dsplit = {k: torch.split(v, size, dim) for k,v in tdict.items()}
     nsecs = [len(v) for v in dsplit.values()]
@@ -27,16 +99,24 @@ class Reader(object):
                  f_name="l_f_delta", gvx_name="grad_vx", 
                  eg_name="eg_base", gveg_name="grad_veg", 
                  gldv_name="grad_ldv", conv_name="conv", 
-                 atom_name="atom", **kwargs):
+                 atom_name="atom", mmap=False, fields=None, 
+                 rank=0, world_size=1, **kwargs):
         self.data_path = data_path
         self.batch_size = batch_size
+        # in distributed training, each rank only uses its shard of frames
+        self.rank = rank
+        self.world_size = world_size
+        # if True, open arrays as memory maps and only gather sampled frames
+        self.mmap = mmap
+        # keys of extra fields to be loaded (if exist), None for all
+        self.fields = None if fields is None else set(fields)
         self.e_path = self.check_exist(e_name+".npy")
-        self.f_path = self.check_exist(f_name+".npy")
+        self.f_path = self.check_field("lb_f", f_name)
         self.d_path = self.check_exist(d_name+".npy")
-        self.gvx_path = self.check_exist(gvx_name+".npy")
-        self.eg_path = self.check_exist(eg_name+".npy")
-        self.gveg_path = self.check_exist(gveg_name+".npy")
-        self.gldv_path = self.check_exist(gldv_name+".npy")
+        self.gvx_path = self.check_field("gvx", gvx_name)
+        self.eg_path = self.check_field("eg0", eg_name)
+        self.gveg_path = self.check_field("gveg", gveg_name)
+        self.gldv_path = self.check_field("gldv", gldv_name)
         self.c_path = self.check_exist(conv_name+".npy")
         self.a_path = self.check_exist(atom_name+".npy")
         # load data
@@ -52,6 +132,10 @@ class Reader(object):
         if os.path.exists(fpath):
             return fpath
 
+    def check_field(self, key, name):
+        if self.fields is None or key in self.fields:
+            return self.check_exist(name+".npy")
+
     def load_meta(self):
         try:
             sys_meta = np.loadtxt(self.check_exist('system.raw'), dtype = int).reshape([-1])
@@ -59,7 +143,7 @@ class Reader(object):
             self.nproj = sys_meta[-1]
         except:
             print('#', self.data_path, f"no system.raw, infer meta from data", file=sys.stderr)
-            sys_shape = np.load(self.d_path).shape
+            sys_shape = np.load(self.d_path, mmap_mode="r").shape
             assert len(sys_shape) == 3, \
                 f"descriptor has to be an order-3 array with shape [nframes, natom, nproj]"
             self.natm = sys_shape[1]
@@ -68,61 +152,121 @@ class Reader(object):
 
     def prepare(self):
         # load energy and check nframes
-        data_ec = np.load(self.e_path).reshape(-1, 1)
-        raw_nframes = data_ec.shape[0]
-        data_dm = np.load(self.d_path).reshape(raw_nframes, self.natm, self.ndesc)
+        data_ec = self.read_array(self.e_path).reshape(-1, 1)
+        self.raw_nframes = raw_nframes = data_ec.shape[0]
         if self.c_path is not None:
-            conv = np.load(self.c_path).reshape(raw_nframes)
+            conv = self.read_array(self.c_path).reshape(raw_nframes)
         else:
             conv = np.ones(raw_nframes, dtype=bool)
-        self.data_ec = data_ec[conv]
-        self.data_dm = data_dm[conv]
-        self.nframes = conv.sum()
+        # index of used (converged and in shard) frames in raw data, None if all used
+        used = np.flatnonzero(conv)[self.rank::self.world_size]
+        self.conv_idx = None if len(used) == raw_nframes else used
+        self.nframes = len(used)
         if self.nframes < self.batch_size:
             self.batch_size = self.nframes
             print('#', self.data_path, 
                  f"reset batch size to {self.batch_size}", file=sys.stderr)
+        self.data_ec = self.filter_conv(data_ec)
         # handle atom and element data
         self.atom_info = {}
         if self.a_path is not None:
-            atoms = np.load(self.a_path).reshape(raw_nframes, self.natm, 4)
-            self.atom_info["elems"] = atoms[:, :, 0][conv].round().astype(int)
-            self.atom_info["coords"] = atoms[:, :, 1:][conv]
-        # load data in torch
+            atoms = self.filter_conv(self.load_array(self.a_path, self.natm, 4))
+            self.atom_info["elems"] = atoms[:, :, 0].round().astype(int)
+            self.atom_info["coords"] = atoms[:, :, 1:]
+        # load data in torch, sharing memory with numpy arrays
+        # in mmap mode, arrays keep all raw frames and are indexed on sampling
         self.t_data = {}
-        self.t_data["lb_e"] = torch.tensor(self.data_ec)
-        self.t_data["eig"] = torch.tensor(self.data_dm)
+        self.raw_keys = set()
+        self.t_data["lb_e"] = torch.from_numpy(self.data_ec)
+        self.add_data("eig", self.d_path, self.natm, self.ndesc)
         if self.f_path is not None and self.gvx_path is not None:
-            self.t_data["lb_f"] = torch.tensor(
-                np.load(self.f_path)\
-                  .reshape(raw_nframes, -1, 3)[conv])
-            self.t_data["gvx"] = torch.tensor(
-                np.load(self.gvx_path)\
-                  .reshape(raw_nframes, -1, 3, self.natm, self.ndesc)[conv])
+            self.add_data("lb_f", self.f_path, -1, 3)
+            self.add_data("gvx", self.gvx_path, -1, 3, self.natm, self.ndesc)
         if self.eg_path is not None and self.gveg_path is not None:
-            self.t_data['eg0'] = torch.tensor(
-                np.load(self.eg_path)\
-                  .reshape(raw_nframes, -1)[conv])
-            self.t_data["gveg"] = torch.tensor(
-                np.load(self.gveg_path)\
-                  .reshape(raw_nframes, self.natm, self.ndesc, -1)[conv])
+            self.add_data("eg0", self.eg_path, -1)
+            self.add_data("gveg", self.gveg_path, self.natm, self.ndesc, -1)
             self.neg = self.t_data['eg0'].shape[-1]
         if self.gldv_path is not None:
-            self.t_data["gldv"] = torch.tensor(
-                np.load(self.gldv_path)\
-                  .reshape(raw_nframes, self.natm, self.ndesc)[conv])
+            self.add_data("gldv", self.gldv_path, self.natm, self.ndesc)
 
-    def sample_train(self):
+    def read_array(self, path, mmap=False):
+        return np.load(path, mmap_mode=("c" if mmap else None))
+
+    def load_array(self, path, *shape):
+        """load array of all raw frames, memory mapped (copy on write) in mmap mode"""
+        data = self.read_array(path, self.mmap)
+        return data.reshape(self.raw_nframes, *shape)
+
+    def filter_conv(self, data):
+        """return data of converged frames, no copy if all frames converged"""
+        return data if self.conv_idx is None else data[self.conv_idx]
+
+    def add_data(self, key, path, *shape):
+        data = self.load_array(path, *shape)
+        if self.mmap:
+            self.raw_keys.add(key)
+        else:
+            data = self.filter_conv(data)
+        self.t_data[key] = torch.from_numpy(data)
+
+    @property
+    def data_dm(self):
+        """descriptors of converged frames, gathered from memory map if needed"""
+        data = self.t_data["eig"].detach().numpy()
+        return self.filter_conv(data) if "eig" in self.raw_keys else data
+
+    def get_frames(self, idx, out=None):
+        """gather data of given frames (indexed among converged frames)
+        
+        if `out` is given, frames are written into its tensors in place.
+        """
+        rows = idx if self.conv_idx is None else self.conv_idx[idx]
+        if out is None:
+            return {k: v[rows if k in self.raw_keys else idx] 
+                    for k, v in self.t_data.items()}
+        for k, v in self.t_data.items():
+            kidx = torch.as_tensor(rows if k in self.raw_keys else idx)
+            if v.dtype == out[k].dtype and out[k].is_contiguous():
+                torch.index_select(v, 0, kidx, out=out[k])
+            else:
+                out[k].copy_(v[kidx])
+        return out
+
+    def sample_train_idx(self):
+        """draw frame indices of next training batch"""
         if self.batch_size == self.nframes == 1:
-            return self.sample_all()
+            return np.arange(1)
         if len(self.idx_queue) < self.batch_size:
             self.idx_queue = np.random.choice(self.nframes, self.nframes, replace=False)
         sample_idx = self.idx_queue[:self.batch_size]
         self.idx_queue = self.idx_queue[self.batch_size:]
-        return {k: v[sample_idx] for k, v in self.t_data.items()}
+        return sample_idx
+
+    def sample_train(self):
+        if self.batch_size == self.nframes == 1:
+            return self.sample_all()
+        return self.get_frames(self.sample_train_idx())
 
     def sample_all(self):
-        return self.t_data
+        if not self.raw_keys:
+            return self.t_data
+        return self.get_frames(np.arange(self.nframes))
+
+    def get_data_keys(self):
+        return self.t_data.keys()
+
+    def cache_embedding(self, embed_fn, chunk_size=1024):
+        """replace descriptors by outputs of a frozen `embed_fn`, computed once"""
+        feat_list, lin_list = [], []
+        for start in range(0, self.nframes, chunk_size):
+            idx = np.arange(start, min(start + chunk_size, self.nframes))
+            feat, lin = embed_fn(self.get_frames(idx)["eig"])
+            feat_list.append(feat)
+            lin_list.append(lin)
+        del self.t_data["eig"]
+        self.raw_keys.discard("eig")
+        self.t_data["feat"] = torch.cat(feat_list)
+        self.t_data["lin"] = torch.cat(lin_list)
 
     def get_train_size(self):
         return self.nframes
@@ -151,8 +295,8 @@ class Reader(object):
         # assert "elem_const" not in self.atom_info, \
         #     "subtract_elem_const has been done. The method should not be executed twice."
         econst = (self.atom_info["nelem"] @ elem_const).reshape(self.nframes, 1)
+        # t_data["lb_e"] shares memory with data_ec
         self.data_ec -= econst
-        self.t_data["lb_e"] -= econst
         self.atom_info["elem_const"] = elem_const
     
     def revert_elem_const(self):
@@ -163,43 +307,112 @@ class Reader(object):
         elem_const = self.atom_info.pop("elem_const")
         econst = (self.atom_info["nelem"] @ elem_const).reshape(self.nframes, 1)
         self.data_ec += econst
-        self.t_data["lb_e"] += econst
-        
+
+
+class PackedReader(Reader):
+    """Reader of one system in a packed dataset, see `deepks.model.pack`"""
+    def __init__(self, pack, sys_idx, batch_size, **kwargs):
+        self.pack = pack
+        self.sys_idx = sys_idx
+        data_path = f"{pack.path}[{pack.names[sys_idx]}]"
+        super().__init__(data_path, batch_size, **kwargs)
+
+    def check_exist(self, fname):
+        if fname is None:
+            return None
+        field = os.path.splitext(fname)[0]
+        if self.pack.has_field(self.sys_idx, field):
+            return field
+
+    def load_meta(self):
+        self.natm, self.nproj = self.pack.get_meta(self.sys_idx)
+        self.ndesc = self.nproj
+
+    def read_array(self, path, mmap=False):
+        data = self.pack.get_array(self.sys_idx, path)
+        if mmap:
+            return data
+        # fields saved in single precision are converted back when loading
+        dtype = np.float64 if data.dtype.kind == "f" else data.dtype
+        return np.array(data, dtype=dtype)
+
+    @property
+    def data_dm(self):
+        return super().data_dm.astype(np.float64, copy=False)
+
+    def get_frames(self, idx, out=None):
+        if out is not None:
+            return super().get_frames(idx, out=out)
+        return {k: v.double() if v.is_floating_point() else v
+                for k, v in super().get_frames(idx).items()}
+
 
 class GroupReader(object) :
-    def __init__ (self, path_list, batch_size=1, group_batch=1, extra_label=True, **kwargs):
+    def __init__ (self, path_list, batch_size=1, group_batch=1, extra_label=True, 
+                  pad_batch=False, pad_bucket=0, rank=0, world_size=1, **kwargs):
         if isinstance(path_list, str):
             path_list = [path_list]
         self.path_list = path_list
         self.batch_size = batch_size
+        # in distributed training, each rank only reads its shard of frames
+        # of every system and statistics of data are gathered from all ranks
+        self.rank = rank
+        self.world_size = world_size
         # init system readers
         Reader_class = (Reader if extra_label 
             and isinstance(kwargs.get('d_name', "dm_eig"), str) 
             else SimpleReader)
+        sys_list = []
+        for ipath in self.path_list :
+            if is_pack(ipath):
+                assert Reader_class is Reader, \
+                    "packed dataset requires extra_label and a single d_name"
+                pack = DataPack(ipath)
+                sys_list.extend((pack, ii) for ii in range(pack.nsystems))
+            else:
+                sys_list.append(ipath)
         self.readers = []
         self.nframes = []
-        for ipath in self.path_list :
-            ireader = Reader_class(ipath, batch_size, **kwargs)
+        for isys in sys_list:
+            if isinstance(isys, tuple):
+                ireader = PackedReader(*isys, batch_size, 
+                                       rank=rank, world_size=world_size, **kwargs)
+            else:
+                ireader = Reader_class(isys, batch_size, 
+                                       rank=rank, world_size=world_size, **kwargs)
             if ireader.get_nframes() == 0:
-                print('# ignore empty dataset:', ipath, file=sys.stderr)
+                print('# ignore empty dataset:', ireader.data_path, file=sys.stderr)
                 continue
             self.readers.append(ireader)
             self.nframes.append(ireader.get_nframes())
-        if not self.readers:
+        # check on all ranks, so no rank is left waiting in later collectives
+        rank_nsys = self.gather(len(self.readers))
+        if min(rank_nsys) == 0:
+            if world_size > 1:
+                raise RuntimeError(
+                    f"No system is avaliable on rank {rank_nsys.index(0)} "
+                    f"of {world_size}, too few frames for that many processes")
             raise RuntimeError("No system is avaliable")
+        self.path_list = [r.data_path for r in self.readers]
         self.nsystems = len(self.readers)
-        data_keys = self.readers[0].sample_all().keys()
+        data_keys = self.readers[0].get_data_keys()
         print(f"# load {self.nsystems} systems with fields {set(data_keys)}")
         # probability of each system
         self.ndesc = self.readers[0].ndesc
         self.sys_prob = [float(ii) for ii in self.nframes] / np.sum(self.nframes)
         
         self.group_batch = max(group_batch, 1)
+        # if True, systems of different sizes are grouped by padding atoms
+        # pad_bucket > 0 limits padding to systems in the same natm range of this width
+        self.pad_batch = pad_batch and self.group_batch > 1
         if self.group_batch > 1:
             self.group_dict = {}
             # self.group_index = {}
             for idx, r in enumerate(self.readers):
-                shape = (r.natm, getattr(r, "neg", None))
+                if self.pad_batch:
+                    shape = (r.natm - 1) // pad_bucket if pad_bucket > 0 else 0
+                else:
+                    shape = (r.natm, getattr(r, "neg", None))
                 if shape in self.group_dict:
                     self.group_dict[shape].append(r)
                     # self.group_index[shape].append(idx)
@@ -234,13 +447,22 @@ class GroupReader(object) :
         return \
             self.readers[idx].sample_train()
 
+    def plan_train(self):
+        """draw readers and frame indices of next training batch without gathering"""
+        if self.group_batch == 1:
+            csys = [self.readers[self.sample_idx()]]
+        else:
+            cidx = np.random.choice(len(self.group_prob), p=list(self.group_prob.values()))
+            cshape = list(self.group_prob.keys())[cidx]
+            cgrp = self.group_dict[cshape]
+            csys = np.random.choice(cgrp, self.group_batch, p=self.batch_prob[cshape])
+        return [(s, s.sample_train_idx()) for s in csys]
+
     def sample_train_group(self):
-        cidx = np.random.choice(len(self.group_prob), p=list(self.group_prob.values()))
-        cshape = list(self.group_prob.keys())[cidx]
-        cgrp = self.group_dict[cshape]
-        csys = np.random.choice(cgrp, self.group_batch, p=self.batch_prob[cshape])
-        batch = concat_batch([s.sample_train() for s in csys], dim=0)
-        return batch
+        batches = [s.get_frames(idx) for s, idx in self.plan_train()]
+        if self.pad_batch:
+            return pad_concat_batch(batches)
+        return concat_batch(batches, dim=0)
 
     def sample_all(self, idx=None) :
         if idx is None:
@@ -250,9 +472,15 @@ class GroupReader(object) :
     
     def sample_all_batch(self, idx=None):
         if idx is not None:
-            all_data = self.sample_all(idx)
+            rd = self.readers[idx]
             size = self.batch_size * self.group_batch
-            yield from split_batch(all_data, size, dim=0)
+            if not hasattr(rd, "get_frames"): # simple reader keeps all in memory
+                yield from split_batch(rd.sample_all(), size, dim=0)
+                return
+            # gather frames chunk by chunk, so memory mapped data is never 
+            # loaded as a whole
+            for start in range(0, rd.get_nframes(), size):
+                yield rd.get_frames(np.arange(start, min(start + size, rd.get_nframes())))
         else:
             for i in range(self.nsystems):
                 yield from self.sample_all_batch(i)
@@ -260,20 +488,30 @@ class GroupReader(object) :
     def get_train_size(self) :
         return np.sum(self.nframes)
 
+    def gather(self, obj):
+        return all_gather(obj) if self.world_size > 1 else [obj]
+
     def get_batch_size(self) :
         return self.batch_size
 
     def compute_data_stat(self, symm_sections=None):
-        all_dm = np.concatenate([r.data_dm.reshape(-1,r.ndesc) for r in self.readers])
-        if symm_sections is None:
-            all_mean, all_std = all_dm.mean(0), all_dm.std(0)
-        else:
-            assert sum(symm_sections) == all_dm.shape[-1]
-            dm_shells = np.split(all_dm, np.cumsum(symm_sections)[:-1], axis=-1)
-            mean_shells = [d.mean().repeat(s) for d, s in zip(dm_shells, symm_sections)]
-            std_shells = [d.std().repeat(s) for d, s in zip(dm_shells, symm_sections)]
-            all_mean = np.concatenate(mean_shells, axis=-1)
-            all_std = np.concatenate(std_shells, axis=-1)
+        # accumulate moments reader by reader, without concatenating all data
+        moments = None
+        for r in self.readers:
+            dm = r.data_dm.reshape(-1, r.ndesc)
+            if symm_sections is None:
+                rmom = get_moments(dm)
+            else:
+                assert sum(symm_sections) == dm.shape[-1]
+                dm_shells = np.split(dm, np.cumsum(symm_sections)[:-1], axis=-1)
+                rmom = tuple(map(np.array, zip(*[get_moments(d.reshape(-1)) for d in dm_shells])))
+            moments = rmom if moments is None else merge_moments(moments, rmom)
+        moments = functools.reduce(merge_moments, self.gather(moments))
+        count, all_mean, all_m2 = moments
+        all_std = np.sqrt(all_m2 / count)
+        if symm_sections is not None:
+            all_mean = all_mean.repeat(symm_sections)
+            all_std = all_std.repeat(symm_sections)
         return all_mean, all_std
 
     def compute_prefitting(self, shift=None, scale=None, ridge_alpha=1e-8, symm_sections=None):
@@ -283,19 +521,24 @@ class GroupReader(object) :
                 shift = all_mean
             if scale is None:
                 scale = all_std
-        all_sdm = np.concatenate([((r.data_dm - shift) / scale).sum(1) for r in self.readers])
-        all_natm = np.concatenate([[float(r.data_dm.shape[1])]*r.data_dm.shape[0] for r in self.readers])
-        if symm_sections is not None: # in this case ridge alpha cannot be 0
-            assert sum(symm_sections) == all_sdm.shape[-1]
-            sdm_shells = np.split(all_sdm, np.cumsum(symm_sections)[:-1], axis=-1)
-            all_sdm = np.stack([d.sum(-1) for d in sdm_shells], axis=-1)
-        # build feature matrix
-        X = np.concatenate([all_sdm, all_natm.reshape(-1,1)], -1)
-        y = np.concatenate([r.data_ec for r in self.readers])
-        I = np.identity(X.shape[1])
+        # accumulate normal equations X^T X and X^T y reader by reader
+        XtX, Xty = 0., 0.
+        for r in self.readers:
+            dm = r.data_dm
+            sdm = ((dm - shift) / scale).sum(1)
+            if symm_sections is not None: # in this case ridge alpha cannot be 0
+                assert sum(symm_sections) == sdm.shape[-1]
+                sdm_shells = np.split(sdm, np.cumsum(symm_sections)[:-1], axis=-1)
+                sdm = np.stack([d.sum(-1) for d in sdm_shells], axis=-1)
+            # build feature matrix
+            X = np.concatenate([sdm, np.full((sdm.shape[0], 1), float(dm.shape[1]))], -1)
+            XtX = XtX + X.T @ X
+            Xty = Xty + X.T @ r.data_ec
+        XtX, Xty = map(sum, zip(*self.gather((XtX, Xty))))
+        I = np.identity(XtX.shape[1])
         I[-1,-1] = 0 # do not punish the bias term
         # solve ridge reg
-        coef = np.linalg.solve(X.T @ X + ridge_alpha * I, X.T @ y).reshape(-1)
+        coef = np.linalg.solve(XtX + ridge_alpha * I, Xty).reshape(-1)
         weight, bias = coef[:-1], coef[-1]
         if symm_sections is not None:
             weight = np.concatenate([w.repeat(s) for w, s in zip(weight, symm_sections)], axis=-1)
@@ -303,26 +546,38 @@ class GroupReader(object) :
     
     def collect_elems(self, elem_list=None):
         if elem_list is None:
-            elem_list = np.array(sorted(set.union(*[
+            elem_list = np.array(sorted(set.union(*self.gather(set.union(*[
                 set(r.atom_info["elems"].flatten()) for r in self.readers
-            ])))
+            ])))))
         for rd in self.readers:
             rd.collect_elems(elem_list)
         return elem_list
 
     def compute_elem_const(self, ridge_alpha=0.):
         elem_list = self.collect_elems()
-        all_nelem = np.concatenate([r.atom_info["nelem"] for r in self.readers])
-        all_ec = np.concatenate([r.data_ec for r in self.readers])
+        # sum and count of energies of each composition (nelem), reader by reader
+        grp_sum = defaultdict(float)
+        grp_cnt = defaultdict(int)
+        for r in self.readers:
+            r_nelem, inv = np.unique(r.atom_info["nelem"], return_inverse=True, axis=0)
+            inv = inv.reshape(-1)
+            r_sum = np.bincount(inv, weights=r.data_ec.reshape(-1), minlength=len(r_nelem))
+            r_cnt = np.bincount(inv, minlength=len(r_nelem))
+            for ne, es, nc in zip(map(tuple, r_nelem), r_sum, r_cnt):
+                grp_sum[ne] += es
+                grp_cnt[ne] += nc
+        if self.world_size > 1:
+            rank_sums, rank_cnts = zip(*self.gather((dict(grp_sum), dict(grp_cnt))))
+            grp_sum, grp_cnt = defaultdict(float), defaultdict(int)
+            for rsum, rcnt in zip(rank_sums, rank_cnts):
+                for ne in rsum:
+                    grp_sum[ne] += rsum[ne]
+                    grp_cnt[ne] += rcnt[ne]
         # lex sort by nelem
-        lexidx = np.lexsort(all_nelem.T)
-        all_nelem = all_nelem[lexidx]
-        all_ec = all_ec[lexidx]
-        # group by nelem
-        _, sidx = np.unique(all_nelem, return_index=True, axis=0)
-        sidx = np.sort(sidx)
-        grp_nelem = all_nelem[sidx]
-        grp_ec = np.array(list(map(np.mean, np.split(all_ec, sidx[1:]))))
+        grp_nelem = np.array(list(grp_sum.keys()))
+        lexidx = np.lexsort(grp_nelem.T)
+        grp_nelem = grp_nelem[lexidx]
+        grp_ec = np.array([grp_sum[ne] / grp_cnt[ne] for ne in map(tuple, grp_nelem)])
         if ridge_alpha <= 0:
             elem_const, _res, _rank, _sing = np.linalg.lstsq(grp_nelem, grp_ec, None)
         else:
@@ -339,14 +594,176 @@ class GroupReader(object) :
         for rd in self.readers:
             rd.revert_elem_const()
 
+    def get_sampler_state(self):
+        """random state and positions of sampling, to continue training later"""
+        return {
+            "np_random": np.random.get_state(),
+            "sample_used": self._sample_used,
+            "idx_queues": [getattr(r, "idx_queue", None) for r in self.readers]
+        }
+
+    def set_sampler_state(self, state):
+        assert len(state["idx_queues"]) == self.nsystems
+        np.random.set_state(state["np_random"])
+        self._sample_used = state["sample_used"]
+        for r, q in zip(self.readers, state["idx_queues"]):
+            if q is not None:
+                r.idx_queue = q
+
+    def cache_embedding(self, embed_fn):
+        for rd in self.readers:
+            rd.cache_embedding(embed_fn)
+
+    def prefetch(self, nbatch=2, pin_memory=False):
+        return BatchPrefetcher(self, nbatch=nbatch, pin_memory=pin_memory)
+
+
+class BatchPrefetcher(object):
+    """Iterate training batches of a GroupReader, assembled in a background thread.
+
+    Batches are drawn in the same random sequence as iterating the reader itself
+    and written into reusable (optionally pinned) buffers, so a yielded batch
+    is only valid until the next one is requested. `sampler_state` holds the
+    state of the reader right after the last yielded batch (or epoch boundary),
+    not the state of the producer, which runs ahead.
+    Free buffers are pooled by shape, at most `max_free` of them in total,
+    and those of the least recently used shapes are dropped first.
+    """
+    def __init__(self, g_reader, nbatch=2, pin_memory=False, max_free=None):
+        self.reader = g_reader
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.queue = queue.Queue(maxsize=max(nbatch, 1))
+        self.free_bufs = OrderedDict()
+        self.nfree = 0
+        self.max_free = max(nbatch, 1) + 1 if max_free is None else max_free
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.current = None
+        self.sampler_state = None
+
+    def __iter__(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.produce, daemon=True)
+            self.thread.start()
+        while True:
+            self.release()
+            item = self.queue.get()
+            if isinstance(item, Exception):
+                raise item
+            if item[0] is None: # end of epoch
+                self.sampler_state = item[1]
+                return
+            key, buf, self.sampler_state = item
+            self.current = key, buf
+            yield buf
+
+    def produce(self):
+        train_size = self.reader.get_train_size()
+        # continue from the (possibly restored) position in the epoch
+        sample_used = self.reader._sample_used
+        try:
+            while not self.stop_event.is_set():
+                # same epoch boundary as GroupReader.__next__
+                if sample_used > train_size:
+                    sample_used = 0
+                    self.put((None, self.snapshot(sample_used)))
+                    continue
+                key, buf = self.assemble(self.reader.plan_train())
+                sample_used += buf["lb_e"].shape[0]
+                # state to continue right after this batch
+                self.put((key, buf, self.snapshot(sample_used)))
+        except Exception as e:
+            self.put(e)
+
+    def snapshot(self, sample_used):
+        state = self.reader.get_sampler_state()
+        state["sample_used"] = sample_used
+        return state
+
+    def put(self, item):
+        while not self.stop_event.is_set():
+            try:
+                return self.queue.put(item, timeout=0.1)
+            except queue.Full:
+                pass
+
+    def assemble(self, plan):
+        # empty gather gives dtype and shape of each field
+        tmpls = [rd.get_frames(idx[:0]) for rd, idx in plan]
+        shapes = {k: [(len(idx), *t[k].shape[1:]) for (_, idx), t in zip(plan, tmpls)]
+                  for k in tmpls[0]}
+        key = tuple((k, v.dtype, padded_shape(shapes[k])) for k, v in tmpls[0].items())
+        with self.lock:
+            buf = self.take_free(key)
+        if buf is None:
+            buf = {k: torch.empty(shape, dtype=dtype, pin_memory=self.pin_memory)
+                   for k, dtype, shape in key}
+            if self.reader.pad_batch:
+                buf["mask"] = torch.empty(buf[atom_key(buf)].shape[:2], dtype=bool, 
+                                          pin_memory=self.pin_memory)
+                fkey = force_key(buf)
+                if fkey is not None:
+                    buf["fmask"] = torch.empty(buf[fkey].shape[:2], dtype=bool,
+                                               pin_memory=self.pin_memory)
+        start = 0
+        with torch.no_grad():
+            if self.reader.pad_batch:
+                for b in buf.values():
+                    b.zero_()
+            for ii, (rd, idx) in enumerate(plan):
+                rd.get_frames(idx, out={k: b[padded_slice(start, shapes[k][ii])] 
+                                        for k, b in buf.items() if k not in MASK_KEYS})
+                if self.reader.pad_batch:
+                    buf["mask"][start:start+len(idx), :shapes[atom_key(buf)][ii][1]] = True
+                    if "fmask" in buf:
+                        buf["fmask"][start:start+len(idx), :shapes[force_key(buf)][ii][1]] = True
+                start += len(idx)
+        return key, buf
+
+    def release(self):
+        if self.current is not None:
+            key, buf = self.current
+            # the evaluator may have set requires_grad on the buffers
+            for b in buf.values():
+                b.requires_grad_(False)
+            with self.lock:
+                self.free_bufs.setdefault(key, []).append(buf)
+                self.free_bufs.move_to_end(key)
+                self.nfree += 1
+                # evict buffers of least recently used shapes beyond the cap
+                while self.nfree > self.max_free:
+                    self.take_free(next(iter(self.free_bufs)))
+            self.current = None
+
+    def take_free(self, key):
+        # call with lock held
+        bufs = self.free_bufs.get(key)
+        if not bufs:
+            return None
+        self.nfree -= 1
+        buf = bufs.pop(0)
+        if not bufs:
+            del self.free_bufs[key]
+        return buf
+
+    def close(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
 
 class SimpleReader(object):
     def __init__(self, data_path, batch_size, 
                  e_name="l_e_delta", d_name="dm_eig", 
-                 conv_filter=True, conv_name="conv", **kwargs):
+                 conv_filter=True, conv_name="conv", 
+                 rank=0, world_size=1, **kwargs):
         # copy from config
         self.data_path = data_path
         self.batch_size = batch_size
+        self.rank = rank
+        self.world_size = world_size
         self.e_name = e_name
         self.d_name = d_name if isinstance(d_name, (list, tuple)) else [d_name]
         self.c_filter = conv_filter
@@ -380,9 +797,10 @@ class SimpleReader(object):
             conv = np.load(os.path.join(self.data_path,f'{self.c_name}.npy')).reshape(raw_nframes)
         else:
             conv = np.ones(raw_nframes, dtype=bool)
-        self.data_ec = data_ec[conv]
-        self.data_dm = data_dm[conv]
-        self.nframes = conv.sum()
+        used = np.flatnonzero(conv)[self.rank::self.world_size]
+        self.data_ec = data_ec[used]
+        self.data_dm = data_dm[used]
+        self.nframes = len(used)
         self.ndesc = self.data_dm.shape[-1]
         # print(np.shape(self.inputs_train))
         if self.nframes < self.batch_size:
@@ -411,6 +829,9 @@ class SimpleReader(object):
             "eig": torch.from_numpy(self.data_dm)
         }
 
+    def get_data_keys(self):
+        return ("lb_e", "eig")
+
     def get_train_size(self) :
         return self.nframes
 
@@ -1,13 +1,12 @@
 import os
 import numpy as np
 import torch
-import torch.nn as nn
 try:
     import deepks
 except ImportError as e:
     import sys
     sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../../")
-from deepks.model.model import CorrNet
+from deepks.model.model import CorrNet, CorrNetEnsemble
 from deepks.model.reader import GroupReader
 from deepks.utils import load_yaml, load_dirs, check_list
 
@@ -15,31 +14,34 @@ from deepks.utils import load_yaml, load_dirs, check_list
 DEVICE = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
 
-def test(model, g_reader, dump_prefix="test", group=False):
+def evaluate(model, g_reader):
+    """return energy labels and predictions of each system
+
+    predictions of an ensemble have an extra leading axis of models.
+    """
     model.eval()
-    loss_fn=nn.MSELoss()
     label_list = []
     pred_list = []
-
     for i in range(g_reader.nsystems):
         sample = g_reader.sample_all(i)
         nframes = sample["lb_e"].shape[0]
         sample = {k: v.to(DEVICE, non_blocking=True) for k, v in sample.items()}
         label, data = sample["lb_e"], sample["eig"]
-        pred = model(data)
-        error = torch.sqrt(loss_fn(pred, label))
+        with torch.no_grad():
+            pred = model(data)
+        label_list.append(label.cpu().numpy().reshape(nframes, -1).sum(axis=-1))
+        pred_list.append(pred.cpu().numpy().reshape(*pred.shape[:-2], nframes, -1).sum(axis=-1))
+    return label_list, pred_list
 
-        error_np = error.item()
-        label_np = label.cpu().numpy().reshape(nframes, -1).sum(axis=1)
-        pred_np = pred.detach().cpu().numpy().reshape(nframes, -1).sum(axis=1)
-        error_l1 = np.mean(np.abs(label_np - pred_np))
-        label_list.append(label_np)
-        pred_list.append(pred_np)
 
+def dump_test(label_list, pred_list, path_list, dump_prefix="test", group=False):
+    for i, (label_np, pred_np) in enumerate(zip(label_list, pred_list)):
+        error_np = np.sqrt(np.mean((label_np - pred_np) ** 2))
+        error_l1 = np.mean(np.abs(label_np - pred_np))
         if not group and dump_prefix is not None:
-            nd = max(len(str(g_reader.nsystems)), 2)
+            nd = max(len(str(len(path_list))), 2)
             dump_res = np.stack([label_np, pred_np], axis=1)
-            header = f"{g_reader.path_list[i]}\nmean l1 error: {error_l1}\nmean l2 error: {error_np}\nreal_ene  pred_ene"
+            header = f"{path_list[i]}\nmean l1 error: {error_l1}\nmean l2 error: {error_np}\nreal_ene  pred_ene"
             filename = f"{dump_prefix}.{i:0{nd}}.out"
             np.savetxt(filename, dump_res, header=header)
             # print(f"system {i} finished")
@@ -56,23 +58,83 @@ def test(model, g_reader, dump_prefix="test", group=False):
     return all_err_l1, all_err_l2
 
 
+def test(model, g_reader, dump_prefix="test", group=False):
+    label_list, pred_list = evaluate(model, g_reader)
+    return dump_test(label_list, pred_list, g_reader.path_list, 
+                     dump_prefix=dump_prefix, group=group)
+
+
+def test_ensemble(ensemble, g_reader, dump_prefixes=None, 
+                  ens_prefix="test.ens", group=False, names=None):
+    """test all members in one pass, and dump mean and std of their predictions"""
+    label_list, pred_list = evaluate(ensemble, g_reader)
+    if dump_prefixes is None:
+        dump_prefixes = [None] * ensemble.nmodel
+    if names is None:
+        names = [f"model {im}" for im in range(ensemble.nmodel)]
+    errors = []
+    for im, (name, prefix) in enumerate(zip(names, dump_prefixes)):
+        print(name)
+        errors.append(dump_test(label_list, [p[im] for p in pred_list], 
+                                g_reader.path_list, dump_prefix=prefix, group=group))
+    mean_list = [p.mean(0) for p in pred_list]
+    std_list = [p.std(0) for p in pred_list]
+    print("ensemble mean:")
+    dump_test(label_list, mean_list, g_reader.path_list, dump_prefix=None)
+    all_std = np.concatenate(std_list)
+    print(f"all systems mean std: {all_std.mean()}\nall systems max std: {all_std.max()}")
+    if ens_prefix is not None:
+        header = "real_ene  mean_ene  std_ene"
+        if group:
+            np.savetxt(f"{ens_prefix}.out", np.stack([np.concatenate(label_list), 
+                np.concatenate(mean_list), all_std], axis=1), header=header)
+        else:
+            nd = max(len(str(g_reader.nsystems)), 2)
+            for i, res in enumerate(zip(label_list, mean_list, std_list)):
+                np.savetxt(f"{ens_prefix}.{i:0{nd}}.out", np.stack(res, axis=1), 
+                           header=f"{g_reader.path_list[i]}\n{header}")
+    return errors
+
+
 def main(data_paths, model_file="model.pth", 
          output_prefix='test', group=False,
-         e_name='l_e_delta', d_name=['dm_eig']):
+         e_name='l_e_delta', d_name=['dm_eig'], ensemble=True):
     data_paths = load_dirs(data_paths)
     if len(d_name) == 1:
         d_name = d_name[0]
     g_reader = GroupReader(data_paths, e_name=e_name, d_name=d_name, 
                            conv_filter=False, extra_label=True)
     model_file = check_list(model_file)
+    dump_list = []
     for f in model_file:
-        print(f)
-        p = os.path.dirname(f)
-        model = CorrNet.load(f).double().to(DEVICE)
-        dump = os.path.join(p, output_prefix)
+        dump = os.path.join(os.path.dirname(f), output_prefix)
         dir_name = os.path.dirname(dump)
         if dir_name:
             os.makedirs(dir_name, exist_ok=True)
+        dump_list.append(dump)
+    # ensemble results go next to the models, in their common folder
+    ens_dir = os.path.commonpath([os.path.abspath(os.path.dirname(f)) for f in model_file])
+    ens_prefix = os.path.join(ens_dir, f"{output_prefix}.ens")
+    models = [CorrNet.load(f) for f in model_file]
+    if ensemble and len(models) > 1:
+        # evaluate all models in one batched pass if they are compatible
+        try:
+            ens = CorrNetEnsemble(models).double().to(DEVICE)
+        except ValueError as e:
+            print(f"# models are tested one by one: {e}")
+        else:
+            if ens.elem_table is not None:
+                elist, econst = ens.elem_table
+                g_reader.collect_elems(elist)
+                g_reader.subtract_elem_const(econst)
+            test_ensemble(ens, g_reader, dump_prefixes=dump_list,
+                          ens_prefix=ens_prefix, group=group,
+                          names=model_file)
+            g_reader.revert_elem_const()
+            return
+    for f, model, dump in zip(model_file, models, dump_list):
+        print(f)
+        model = model.double().to(DEVICE)
         if model.elem_table is not None:
             elist, econst = model.elem_table
             g_reader.collect_elems(elist)
@@ -1,22 +1,36 @@
 import os
 import sys
+import csv
+import json
+import queue
+import pickle
+import inspect
+import socket
+import resource
+import threading
+import itertools
 import numpy as np
 from numpy.lib.arraysetops import isin
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
-from time import time
+import torch.distributed as dist
+from time import time, perf_counter
 try:
     import deepks
 except ImportError as e:
     sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../../")
 from deepks.model.model import CorrNet
-from deepks.model.reader import GroupReader
+from deepks.model.reader import GroupReader, all_gather
 from deepks.utils import load_dirs, load_elem_table
 
 
 DEVICE = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+# training state holds non-tensor objects (e.g. numpy random state), 
+# so it has to be fully unpickled where torch.load supports `weights_only`
+STATE_LOAD_ARGS = ({"weights_only": False} 
+    if "weights_only" in inspect.signature(torch.load).parameters else {})
 
 
 def fit_elem_const(g_reader, test_reader=None, elem_table=None, ridge_alpha=0.):
@@ -57,7 +71,7 @@ def preprocess(model, g_reader,
 
 
 def make_loss(cap=None, shrink=None, reduction="mean"):
-    def loss_fn(input, target):
+    def loss_fn(input, target, mask=None):
         diff = target - input
         if shrink and shrink > 0:
             diff = F.softshrink(diff, shrink)
@@ -65,10 +79,14 @@ def make_loss(cap=None, shrink=None, reduction="mean"):
         if cap and cap > 0:
             abdf = diff.abs()
             sqdf = torch.where(abdf < cap, sqdf, cap * (2*abdf - cap))
+        if mask is not None:
+            # only count entries of real (not padded) atoms
+            mask = mask.to(sqdf).expand_as(sqdf)
+            sqdf = sqdf * mask
         if reduction is None or reduction.lower() == "none":
             return sqdf
         elif reduction.lower() == "mean":
-            return sqdf.mean()
+            return sqdf.mean() if mask is None else sqdf.sum() / mask.sum()
         elif reduction.lower() == "sum":
             return sqdf.sum()
         elif reduction.lower() in ("batch", "bmean"):
@@ -104,11 +122,33 @@ class Evaluator:
         self.d_factor = density_factor
         # gradient penalty, not very useful
         self.g_penalty = grad_penalty
+        # unweighted loss terms of last call, kept as tensors to avoid syncing
+        self.loss_terms = {}
+
+    def required_fields(self):
+        """keys of sample data used by the active loss terms"""
+        fields = {"lb_e", "eig"}
+        if self.f_factor > 0:
+            fields |= {"lb_f", "gvx"}
+        if self.g_penalty > 0:
+            fields |= {"eg0", "gveg"}
+        if self.d_factor > 0:
+            fields |= {"gldv"}
+        return fields
 
     def __call__(self, model, sample):
         _dref = next(model.parameters())
         tot_loss = 0.
-        sample = {k: v.to(_dref, non_blocking=True) for k, v in sample.items()}
+        sample = {k: v.to(_dref if v.is_floating_point() else _dref.device, non_blocking=True) 
+                  for k, v in sample.items()}
+        # atom mask only exists in padded batches
+        mask = sample.get("mask", None)
+        if "feat" in sample:
+            # descriptors are replaced by cached outputs of the frozen embedding
+            e_pred = model.fit(sample["feat"], sample["lin"], mask)
+            e_loss = self.e_lossfn(e_pred, sample["lb_e"])
+            self.loss_terms = {"energy": e_loss.detach()}
+            return self.e_factor * e_loss
         e_label, eig = sample["lb_e"], sample["eig"]
         nframe = e_label.shape[0]
         requires_grad =  ( (self.f_factor > 0 and "lb_f" in sample) 
@@ -116,8 +156,10 @@ class Evaluator:
                         or self.g_penalty > 0)
         eig.requires_grad_(requires_grad)
         # begin the calculation
-        e_pred = model(eig)
-        tot_loss = tot_loss + self.e_factor * self.e_lossfn(e_pred, e_label)
+        e_pred = model(eig) if mask is None else model(eig, mask)
+        e_loss = self.e_lossfn(e_pred, e_label)
+        terms = self.loss_terms = {"energy": e_loss.detach()}
+        tot_loss = tot_loss + self.e_factor * e_loss
         if requires_grad:
             [gev] = torch.autograd.grad(e_pred, eig, 
                         grad_outputs=torch.ones_like(e_pred),
@@ -126,35 +168,266 @@ class Evaluator:
             if self.g_penalty > 0 and "eg0" in sample:
                 eg_base, gveg = sample["eg0"], sample["gveg"]
                 eg_tot = torch.einsum('...apg,...ap->...g', gveg, gev) + eg_base
-                tot_loss = tot_loss + self.g_penalty * eg_tot.pow(2).mean(0).sum()
+                g_loss = eg_tot.pow(2).mean(0).sum()
+                terms["grad"] = g_loss.detach()
+                tot_loss = tot_loss + self.g_penalty * g_loss
             # optional force calculation
             if self.f_factor > 0 and "lb_f" in sample:
                 f_label, gvx = sample["lb_f"], sample["gvx"]
                 f_pred = - torch.einsum("...bxap,...ap->...bx", gvx, gev)
-                tot_loss = tot_loss + self.f_factor * self.f_lossfn(f_pred, f_label)
+                if mask is None:
+                    f_loss = self.f_lossfn(f_pred, f_label)
+                else:
+                    # forces are per raw atom, which may differ from descriptors
+                    fmask = sample["fmask"]
+                    f_loss = self.f_lossfn(f_pred, f_label, mask=fmask.unsqueeze(-1))
+                terms["force"] = f_loss.detach()
+                tot_loss = tot_loss + self.f_factor * f_loss
             # density loss with fix head grad
             if self.d_factor > 0 and "gldv" in sample:
                 gldv = sample["gldv"]
-                tot_loss = tot_loss + self.d_factor * (gldv * gev).mean(0).sum()
+                d_loss = (gldv * gev).mean(0).sum()
+                terms["density"] = d_loss.detach()
+                tot_loss = tot_loss + self.d_factor * d_loss
         return tot_loss
 
 
+def make_embed_fn(model, device=DEVICE):
+    def embed_fn(eig):
+        with torch.no_grad():
+            feat, lin = model.embed(eig.to(device))
+        return feat.cpu(), lin.cpu()
+    return embed_fn
+
+
+def clone_state(obj):
+    """copy all tensors in a (nested) state to cpu, so training can go on"""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: clone_state(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(clone_state(v) for v in obj)
+    return obj
+
+
+class CheckpointWriter:
+    """Save checkpoints in a background thread.
+
+    Each file is first written to a temporary name and then moved in place,
+    while previous versions are rotated to `file.1`, `file.2`, ... 
+    """
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self.work, daemon=True)
+        self.thread.start()
+
+    def submit(self, filename, state, nkeep=1):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((filename, clone_state(state), nkeep))
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self.write(*item)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    @staticmethod
+    def write(filename, state, nkeep=1):
+        tmp_name = f"{filename}.tmp"
+        torch.save(state, tmp_name)
+        for ii in range(nkeep-1, 0, -1):
+            src = filename if ii == 1 else f"{filename}.{ii-1}"
+            if os.path.exists(src):
+                os.replace(src, f"{filename}.{ii}")
+        os.replace(tmp_name, filename)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+class TrainMonitor:
+    """Record throughput, time split, peak memory and loss terms of each epoch.
+
+    Time of each step is split into phases by calling `lap` at their ends.
+    Records are appended to a csv file, or a jsonl file if the name ends so.
+    """
+    PHASES = ("data", "forward", "backward", "comm", "step")
+
+    def __init__(self, filename=None, device=DEVICE, append=False):
+        self.filename = filename
+        self.cuda = torch.device(device).type == "cuda"
+        self.writer = None
+        if filename:
+            exists = append and os.path.exists(filename) and os.path.getsize(filename) > 0
+            self.file = open(filename, "a" if append else "w", newline="")
+            self.jsonl = filename.endswith(".jsonl")
+            self.need_header = not exists
+        self.start_epoch()
+
+    def start_epoch(self):
+        self.times = dict.fromkeys(self.PHASES, 0.)
+        self.nbatch, self.nframe = 0, 0
+        self.terms = {}
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats()
+        self.t_start = self.t_last = perf_counter()
+
+    def lap(self, phase):
+        if self.cuda: # kernels are asynchronous
+            torch.cuda.synchronize()
+        now = perf_counter()
+        self.times[phase] += now - self.t_last
+        self.t_last = now
+
+    def add_batch(self, nframe, loss_terms):
+        self.nbatch += 1
+        self.nframe += nframe
+        for k, v in loss_terms.items():
+            self.terms[k] = self.terms.get(k, 0.) + v
+
+    def peak_memory(self):
+        """peak memory in MB, of the device if on gpu, or the process otherwise"""
+        if self.cuda:
+            return torch.cuda.max_memory_allocated() / 2**20
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+    def end_epoch(self, epoch, **extra):
+        t_total = perf_counter() - self.t_start
+        record = {
+            "epoch": epoch,
+            "nbatch": self.nbatch,
+            "nframe": self.nframe,
+            "frames_per_sec": self.nframe / t_total if t_total > 0 else 0.,
+            "t_total": t_total,
+            **{f"t_{k}": v for k, v in self.times.items()},
+            "peak_mem_mb": self.peak_memory(),
+            **{f"loss_{k}": (v / self.nbatch).item() for k, v in self.terms.items()},
+            **extra,
+        }
+        if self.filename:
+            self.write(record)
+        self.start_epoch()
+        return record
+
+    def write(self, record):
+        if self.jsonl:
+            self.file.write(json.dumps(record) + "\n")
+        else:
+            if self.writer is None:
+                self.writer = csv.DictWriter(self.file, fieldnames=list(record))
+                if self.need_header:
+                    self.writer.writeheader()
+            self.writer.writerow(record)
+        self.file.flush()
+
+    def close(self):
+        if self.filename:
+            self.file.close()
+
+
+def load_train_state(filename, nkeep=1):
+    """load the latest readable training state among rotated files"""
+    for fname in [filename] + [f"{filename}.{ii}" for ii in range(1, nkeep)]:
+        if not os.path.exists(fname):
+            continue
+        try:
+            return torch.load(fname, map_location="cpu", **STATE_LOAD_ARGS)
+        except (RuntimeError, EOFError, pickle.UnpicklingError) as e:
+            # corrupted or partially written file, try the previous one
+            print(f"# failed to load training state {fname}: {e}", file=sys.stderr)
+    return None
+
+
+def eval_loss(evaluator, model, reader):
+    """mean loss over all frames, gathered from all ranks if reader is sharded"""
+    loss_sum, nframe = 0., 0
+    for batch in reader.sample_all_batch():
+        nf = batch["lb_e"].shape[0]
+        loss_sum += evaluator(model, batch).item() * nf
+        nframe += nf
+    loss_sum, nframe = map(sum, zip(*reader.gather((loss_sum, nframe))))
+    return loss_sum / nframe
+
+
+def allreduce_step(model, loss, nframe):
+    """average gradients and float buffers over ranks
+
+    return the averaged loss and the total number of frames of this step.
+    """
+    world_size = dist.get_world_size()
+    grads = [p.grad for p in model.parameters() if p.grad is not None]
+    # running stats of embedding are updated with local batches
+    bufs = [b for b in model.buffers() if b.is_floating_point()]
+    _dref = next(model.parameters())
+    flat = torch.cat([t.reshape(-1).to(_dref) for t in grads + bufs]
+                     + [torch.tensor([loss, nframe]).to(_dref)])
+    dist.all_reduce(flat)
+    offset = 0
+    for t in grads + bufs:
+        t.copy_(flat[offset:offset+t.numel()].view_as(t) / world_size)
+        offset += t.numel()
+    return flat[-2].item() / world_size, int(flat[-1].item())
+
+
 def train(model, g_reader, n_epoch=1000, test_reader=None, *,
           energy_factor=1., force_factor=0., density_factor=0.,
           energy_loss=None, force_loss=None, grad_penalty=0.,
           start_lr=0.001, decay_steps=100, decay_rate=0.96, stop_lr=None,
-          weight_decay=0.,  fix_embedding=False,
+          weight_decay=0.,  fix_embedding=False, cache_embedding=False,
           display_epoch=100, ckpt_file="model.pth",
-          graph_file=None, device=DEVICE):
+          graph_file=None, device=DEVICE, 
+          prefetch=0, pin_memory=False,
+          state_file=True, state_nkeep=2, resume=True, stat_file=True):
     
     model = model.to(device)
     model.eval()
     print("# working on device:", device)
     if test_reader is None:
         test_reader = g_reader
+    # data parallel training if the reader is sharded
+    world_size, rank = g_reader.world_size, g_reader.rank
+    if world_size > 1:
+        print(f"# data parallel training with {world_size} processes")
+        for t in model.state_dict().values():
+            dist.broadcast(t, 0)
+    # save training state next to the checkpoint by default, and
+    # continue from it if exists, unless resume is False
+    if state_file is True:
+        state_file = (os.path.splitext(ckpt_file)[0] + ".state.pt"
+                      if ckpt_file else None)
+    state = None
+    if state_file and resume:
+        state = load_train_state(state_file, state_nkeep)
+    if state is not None:
+        model.load_state_dict(state["model"]["state_dict"])
+        print(f"# resume training from epoch {state['epoch']} in {state_file}")
     # fix parameters if needed
     if fix_embedding and model.embedder is not None:
         model.embedder.requires_grad_(False)
+    # compute frozen embedding of data only once if no loss needs gradient to eig
+    if cache_embedding:
+        if force_factor > 0 or density_factor > 0 or grad_penalty > 0:
+            print("# embedding not cached: loss requires gradient to descriptors")
+        elif not model.has_frozen_embedding():
+            print("# embedding not cached: embedding is trainable or not fixed yet")
+        else:
+            embed_fn = make_embed_fn(model, device)
+            g_reader.cache_embedding(embed_fn)
+            if test_reader is not g_reader:
+                test_reader.cache_embedding(embed_fn)
+            print("# use cached outputs of the frozen embedding")
     # set up optimizer and lr scheduler
     optimizer = optim.Adam(model.parameters(), lr=start_lr, weight_decay=weight_decay)
     if stop_lr is not None:
@@ -162,6 +435,51 @@ def train(model, g_reader, n_epoch=1000, test_reader=None, *,
         print(f"# resetting decay_rate: {decay_rate:.4f} "
               + f"to satisfy stop_lr: {stop_lr:.2e}")
     scheduler = optim.lr_scheduler.StepLR(optimizer, decay_steps, decay_rate)
+    start_epoch = 0
+    if state is not None:
+        optimizer.load_state_dict(state["optimizer"])
+        scheduler.load_state_dict(state["scheduler"])
+        sampler_state = state["sampler"]
+        if isinstance(sampler_state, list): # saved by all ranks
+            assert len(sampler_state) == world_size
+            sampler_state = sampler_state[rank]
+        if sampler_state is not None:
+            g_reader.set_sampler_state(sampler_state)
+        else:
+            print("# no sampler state saved, batches are drawn afresh", file=sys.stderr)
+        torch.set_rng_state(state["torch_random"])
+        if torch.cuda.is_available() and state.get("cuda_random") is not None:
+            torch.cuda.set_rng_state_all(state["cuda_random"])
+        start_epoch = state["epoch"]
+    # write checkpoints in background, only on rank 0
+    writer = CheckpointWriter() if rank == 0 else None
+    def save_state(epoch):
+        # state of the reader after the last batch the optimizer consumed
+        sampler_state = (trn_iter.sampler_state if prefetch > 0 
+                         else g_reader.get_sampler_state())
+        if world_size > 1:
+            sampler_state = all_gather(sampler_state)
+        if writer is None:
+            return
+        if ckpt_file:
+            writer.submit(ckpt_file, model.save_dict())
+        if state_file:
+            writer.submit(state_file, {
+                "model": model.save_dict(),
+                "optimizer": optimizer.state_dict(),
+                "scheduler": scheduler.state_dict(),
+                "sampler": sampler_state,
+                "torch_random": torch.get_rng_state(),
+                "cuda_random": (torch.cuda.get_rng_state_all() 
+                                if torch.cuda.is_available() else None),
+                "epoch": epoch,
+            }, nkeep=state_nkeep)
+    # record statistics of each epoch next to the checkpoint, by default
+    if stat_file is True:
+        stat_file = (os.path.splitext(ckpt_file)[0] + ".stat.csv" 
+                     if ckpt_file else None)
+    monitor = TrainMonitor(stat_file if rank == 0 else None, 
+                           device=device, append=state is not None)
     # make evaluators for training
     evaluator = Evaluator(energy_factor=energy_factor, force_factor=force_factor, 
                           energy_lossfn=energy_loss, force_lossfn=force_loss,
@@ -170,44 +488,72 @@ def train(model, g_reader, n_epoch=1000, test_reader=None, *,
     test_eval = Evaluator(energy_factor=1., energy_lossfn=L2LOSS, 
                           force_factor=0., density_factor=0., grad_penalty=0.)
 
+    # assemble next batches in background if required
+    trn_iter = (g_reader.prefetch(prefetch, pin_memory=pin_memory) 
+                if prefetch > 0 else g_reader)
+    if world_size > 1:
+        # ranks draw batches continuously and end the epoch together,
+        # when frames used by all ranks exceed the total training size
+        trn_stream = itertools.chain.from_iterable(itertools.repeat(trn_iter))
+        trn_size = sum(g_reader.gather(g_reader.get_train_size()))
+
     print("# epoch      trn_err   tst_err        lr  trn_time  tst_time ")
     tic = time()
-    trn_loss = np.mean([evaluator(model, batch).item() 
-                    for batch in g_reader.sample_all_batch()])
-    tst_loss = np.mean([test_eval(model, batch).item() 
-                    for batch in test_reader.sample_all_batch()])
+    trn_loss = eval_loss(evaluator, model, g_reader)
+    tst_loss = eval_loss(test_eval, model, test_reader)
     tst_time = time() - tic
-    print(f"  {0:<8d}  {np.sqrt(np.abs(trn_loss)):>.2e}  {np.sqrt(np.abs(tst_loss)):>.2e}"
-          f"  {start_lr:>.2e}  {0:>8.2f}  {tst_time:>8.2f}")
+    print(f"  {start_epoch:<8d}  {np.sqrt(np.abs(trn_loss)):>.2e}  {np.sqrt(np.abs(tst_loss)):>.2e}"
+          f"  {scheduler.get_last_lr()[0]:>.2e}  {0:>8.2f}  {tst_time:>8.2f}")
 
-    for epoch in range(1, n_epoch+1):
+    for epoch in range(start_epoch+1, n_epoch+1):
         tic = time()
         loss_list = []
-        for sample in g_reader:
+        nused = 0
+        monitor.start_epoch()
+        for sample in (trn_iter if world_size == 1 else trn_stream):
+            monitor.lap("data")
             model.train()
             optimizer.zero_grad()
             loss = evaluator(model, sample)
+            monitor.lap("forward")
             loss.backward()
+            monitor.lap("backward")
+            nframe = sample["lb_e"].shape[0]
+            if world_size > 1:
+                loss_val, nframe = allreduce_step(model, loss.item(), nframe)
+                nused += nframe
+                monitor.lap("comm")
+            else:
+                loss_val = loss.item()
             optimizer.step()
-            loss_list.append(loss.item())
+            loss_list.append(loss_val)
+            monitor.add_batch(nframe, evaluator.loss_terms)
+            monitor.lap("step")
+            if world_size > 1 and nused > trn_size:
+                break
+        lr = scheduler.get_last_lr()[0]
         scheduler.step()
+        trn_loss = np.mean(loss_list)
+        trn_time = time() - tic
 
+        tst_loss = None
         if epoch % display_epoch == 0:
             model.eval()
-            trn_loss = np.mean(loss_list)
-            trn_time = time() - tic
             tic = time()
-            tst_loss = np.mean([test_eval(model, batch).item() 
-                            for batch in test_reader.sample_all_batch()])
+            tst_loss = eval_loss(test_eval, model, test_reader)
             tst_time = time() - tic
             print(f"  {epoch:<8d}  {np.sqrt(np.abs(trn_loss)):>.2e}  {np.sqrt(np.abs(tst_loss)):>.2e}"
                   f"  {scheduler.get_last_lr()[0]:>.2e}  {trn_time:>8.2f}  {tst_time:8.2f}")
-            if ckpt_file:
-                model.save(ckpt_file)
+            save_state(epoch)
+        monitor.end_epoch(epoch, lr=lr, trn_loss=trn_loss, tst_loss=tst_loss)
 
-    if ckpt_file:
-        model.save(ckpt_file)
-    if graph_file:
+    if prefetch > 0:
+        trn_iter.close()
+    save_state(n_epoch)
+    monitor.close()
+    if writer is not None:
+        writer.close()
+    if graph_file and rank == 0:
         model.compile_save(graph_file)
     
 
@@ -216,10 +562,19 @@ def main(train_paths, test_paths=None,
          model_args=None, data_args=None, 
          preprocess_args=None, train_args=None, 
          proj_basis=None, fit_elem=False, 
-         seed=None, device=None):
+         seed=None, device=None, nproc=None):
+
+    if nproc is not None and nproc > 1 and "WORLD_SIZE" not in os.environ:
+        return spawn_main(nproc, train_paths=train_paths, test_paths=test_paths,
+            restart=restart, ckpt_file=ckpt_file, model_args=model_args, 
+            data_args=data_args, preprocess_args=preprocess_args, 
+            train_args=train_args, proj_basis=proj_basis, fit_elem=fit_elem, 
+            seed=seed, device=device)
+    rank, world_size = init_distributed()
    
     if seed is None: 
         seed = np.random.randint(0, 2**32)
+    seed = all_gather(seed)[0] # use the same seed as rank 0
     print(f'# using seed: {seed}')
     np.random.seed(seed)
     torch.manual_seed(seed)
@@ -235,13 +590,21 @@ def main(train_paths, test_paths=None,
     if device is not None:
         train_args["device"] = device
 
+    # only load data fields used by the loss terms
+    loss_args = {k: train_args[k] for k in 
+        ("energy_factor", "force_factor", "density_factor", "grad_penalty") 
+        if k in train_args}
+    trn_fields = data_args.get("fields", Evaluator(**loss_args).required_fields())
+    tst_fields = data_args.get("fields", Evaluator().required_fields())
+
     train_paths = load_dirs(train_paths)
     # print(f'# training with {len(train_paths)} system(s)')
-    g_reader = GroupReader(train_paths, **data_args)
+    dist_args = {"rank": rank, "world_size": world_size}
+    g_reader = GroupReader(train_paths, **{**data_args, "fields": trn_fields}, **dist_args)
     if test_paths is not None:
         test_paths = load_dirs(test_paths)
         # print(f'# testing with {len(test_paths)} system(s)')
-        test_reader = GroupReader(test_paths, **data_args)
+        test_reader = GroupReader(test_paths, **{**data_args, "fields": tst_fields}, **dist_args)
     else:
         print('# testing with training set')
         test_reader = None
@@ -265,9 +628,47 @@ def main(train_paths, test_paths=None,
         model = CorrNet(**model_args).double()
         
     preprocess(model, g_reader, **preprocess_args)
+    if world_size > 1: # draw different batches on each rank
+        np.random.seed((seed + rank) % 2**32)
     train(model, g_reader, test_reader=test_reader, **train_args)
 
 
+def init_distributed():
+    """init gloo process group from env variables (e.g. set by torchrun)
+    
+    return rank and world size. outputs of ranks other than 0 are suppressed.
+    """
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    if world_size <= 1:
+        return 0, 1
+    if not dist.is_initialized():
+        dist.init_process_group("gloo")
+    rank = dist.get_rank()
+    if rank != 0:
+        sys.stdout = open(os.devnull, "w")
+    if "OMP_NUM_THREADS" not in os.environ:
+        nlocal = int(os.environ.get("LOCAL_WORLD_SIZE", world_size))
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // nlocal))
+    return rank, world_size
+
+
+def spawn_main(nproc, **kwargs):
+    """run `main` in `nproc` local processes for data parallel training"""
+    if "MASTER_PORT" not in os.environ:
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            os.environ["MASTER_PORT"] = str(sock.getsockname()[1])
+    os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+    torch.multiprocessing.spawn(run_rank, args=(nproc, kwargs), nprocs=nproc)
+
+
+def run_rank(rank, nproc, kwargs):
+    os.environ.update(RANK=str(rank), WORLD_SIZE=str(nproc),
+                      LOCAL_RANK=str(rank), LOCAL_WORLD_SIZE=str(nproc))
+    main(**kwargs)
+    dist.destroy_process_group()
+
+
 if __name__ == "__main__":
     from deepks.main import train_cli as cli
     cli()
\ No newline at end of file
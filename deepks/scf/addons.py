@@ -14,7 +14,7 @@ def t_ele_grad(bfock, c_vir, c_occ, n_occ):
     return g.flatten(-2)
 
 
-def make_grad_eig_egrad(dscf, mo_coeff=None, mo_occ=None, gfock=None):
+def make_grad_eig_egrad(dscf, mo_coeff=None, mo_occ=None, gfock=None, analytic=True):
     if mo_occ is None: 
         mo_occ = dscf.mo_occ
     if mo_coeff is None: 
@@ -23,7 +23,8 @@ def make_grad_eig_egrad(dscf, mo_coeff=None, mo_occ=None, gfock=None):
         dm = dscf.make_rdm1(mo_coeff, mo_occ)
         if dm.ndim >= 3 and isinstance(dscf, scf.uhf.UHF):
             dm = dm.sum(0)
-        gfock = t_make_grad_eig_dm(torch.from_numpy(dm), dscf._t_ovlp_shells).numpy()
+        gfock = t_make_grad_eig_dm(torch.from_numpy(dm), dscf._t_ovlp_shells, 
+                                   analytic=analytic).numpy()
     if mo_coeff.ndim >= 3 and mo_occ.ndim >= 2:
         return np.concatenate([make_grad_eig_egrad(dscf, mc, mo, gfock) 
             for mc, mo in zip(mo_coeff, mo_occ)], axis=-1)
@@ -67,8 +68,8 @@ def gen_coul_loss(dscf, fock=None, ovlp=None, mo_occ=None):
     return _coul_loss_grad
 
 
-def make_grad_coul_veig(dscf, target_dm):
-    clfn = gen_coul_loss(dscf)
+def make_grad_coul_veig(dscf, target_dm, fock=None, ovlp=None):
+    clfn = gen_coul_loss(dscf, fock=fock, ovlp=ovlp)
     dm = dscf.make_rdm1()
     if dm.ndim == 3 and isinstance(dscf, scf.uhf.UHF):
         dm = dm.sum(0)
@@ -83,8 +84,10 @@ def make_grad_coul_veig(dscf, target_dm):
 
 def calc_optim_veig(dscf, target_dm, 
                     target_dec=None, gvx=None, 
-                    nstep=1, force_factor=1., **optim_args):
-    clfn = gen_coul_loss(dscf, fock=dscf.get_fock(vhf=dscf.get_veff0()))
+                    nstep=1, force_factor=1., fock=None, **optim_args):
+    if fock is None:
+        fock = dscf.get_fock(vhf=dscf.get_veff0())
+    clfn = gen_coul_loss(dscf, fock=fock)
     dm = dscf.make_rdm1()
     if dm.ndim == 3 and isinstance(dscf, scf.uhf.UHF):
         dm = dm.sum(0)
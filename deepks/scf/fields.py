@@ -1,6 +1,7 @@
 import numpy as np
 from typing import List, Callable
 from dataclasses import dataclass, field
+from pyscf import lib
 
 # Field = namedtuple("Field", ["name", "alias", "calc", "shape"])
 # LabelField = namedtuple("LabelField", ["name", "alias", "calc", "shape", "required_labels"])
@@ -11,6 +12,39 @@ class Field:
       calc: Callable
       shape: str
       required_labels: List[str] = field(default_factory=list)
+      # shared quantities (see QUANTITIES) passed to calc as keyword arguments
+      depends: List[str] = field(default_factory=list)
+
+
+@dataclass
+class Quantity:
+      name: str
+      calc: Callable
+      depends: List[str] = field(default_factory=list)
+
+
+class FieldEvaluator:
+    """Evaluate fields of a converged solver, sharing the quantities they depend on.
+
+    Each quantity in QUANTITIES is computed at most once per solver (frame),
+    so requesting many fields does not repeat the expensive base method calls.
+    """
+    def __init__(self, mf):
+        self.mf = mf
+        self.values = {}
+
+    def __getitem__(self, name):
+        if name not in self.values:
+            qt = QUANTITIES[name]
+            self.values[name] = qt.calc(self.mf, **{d: self[d] for d in qt.depends})
+        return self.values[name]
+
+    def calc(self, fd, labels=None):
+        if labels is None:
+            labels = {}
+        return fd.calc(self.mf, 
+                       **{d: self[d] for d in fd.depends},
+                       **{k: labels[k] for k in fd.required_labels})
 
 
 def select_fields(names):
@@ -24,6 +58,32 @@ def select_fields(names):
     return {"scf": scfs, "grad": grads}
 
 
+def make_veff(mf, dm, veff0):
+    """same as `mf.get_veff(dm=dm)` of CorrMixin, reusing the base potential"""
+    ec, vc = mf.get_corr(dm)
+    return lib.tag_array(veff0 + vc, ec=ec, v0=veff0)
+
+
+QUANTITIES = {qt.name: qt for qt in [
+    Quantity("dm", lambda mf: mf.make_rdm1()),
+    Quantity("hcore", lambda mf: mf.get_hcore()),
+    Quantity("ovlp", lambda mf: mf.get_ovlp()),
+    Quantity("veff0", 
+             lambda mf, dm: mf.get_veff0(dm=dm), 
+             ["dm"]),
+    Quantity("veff", make_veff, ["dm", "veff0"]),
+    Quantity("fock0", 
+             lambda mf, dm, hcore, veff0: mf.get_fock(h1e=hcore, vhf=veff0, dm=dm), 
+             ["dm", "hcore", "veff0"]),
+    Quantity("fock", 
+             lambda mf, dm, hcore, veff: mf.get_fock(h1e=hcore, vhf=veff, dm=dm), 
+             ["dm", "hcore", "veff"]),
+    Quantity("e_base", 
+             lambda mf, dm, hcore, veff0: mf.energy_tot0(dm, hcore, veff0), 
+             ["dm", "hcore", "veff0"]),
+]}
+
+
 BOHR = 0.52917721092
 
 def isinbohr(mol):
@@ -50,40 +110,48 @@ SCF_FIELDS = [
           ["ebase", "ene_base", "e0",
            "e_hf", "ehf", "ene_hf", 
            "e_ks", "eks", "ene_ks"], 
-          lambda mf: mf.energy_tot0(),
-          "(nframe, 1)"),
+          lambda mf, e_base: e_base,
+          "(nframe, 1)",
+          depends=["e_base"]),
     Field("e_tot", 
           ["e_cf", "ecf", "ene_cf", "etot", "ene", "energy", "e"],
           lambda mf: mf.e_tot,
           "(nframe, 1)"),
     Field("rdm",
           ["dm"],
-          lambda mf: mf.make_rdm1(),
-          "(nframe, nao, nao)"),
+          lambda mf, dm: dm,
+          "(nframe, nao, nao)",
+          depends=["dm"]),
     Field("proj_dm",
           ["pdm"],
-          lambda mf: mf.make_pdm(flatten=True),
-          "(nframe, natom, -1)"),
+          lambda mf, dm: mf.make_pdm(dm, flatten=True),
+          "(nframe, natom, -1)",
+          depends=["dm"]),
     Field("dm_eig",
           ["eig"],
-          lambda mf: mf.make_eig(),
-          "(nframe, natom, nproj)"),
+          lambda mf, dm: mf.make_eig(dm),
+          "(nframe, natom, nproj)",
+          depends=["dm"]),
     Field("hcore_eig",
           ["heig"],
-          lambda mf: mf.make_eig(mf.get_hcore()),
-          "(nframe, natom, nproj)"),
+          lambda mf, hcore: mf.make_eig(hcore),
+          "(nframe, natom, nproj)",
+          depends=["hcore"]),
     Field("ovlp_eig",
           ["oeig"],
-          lambda mf: mf.make_eig(mf.get_ovlp()),
-          "(nframe, natom, nproj)"),
+          lambda mf, ovlp: mf.make_eig(ovlp),
+          "(nframe, natom, nproj)",
+          depends=["ovlp"]),
     Field("veff_eig",
           ["veig"],
-          lambda mf: mf.make_eig(mf.get_veff()),
-          "(nframe, natom, nproj)"),
+          lambda mf, veff: mf.make_eig(veff),
+          "(nframe, natom, nproj)",
+          depends=["veff"]),
     Field("fock_eig",
           ["feig"],
-          lambda mf: mf.make_eig(mf.get_fock()),
-          "(nframe, natom, nproj)"),
+          lambda mf, fock: mf.make_eig(fock),
+          "(nframe, natom, nproj)",
+          depends=["fock"]),
     Field("conv", 
           ["converged", "convergence"], 
           lambda mf: mf.converged,
@@ -104,9 +172,10 @@ SCF_FIELDS = [
           ["energy"]),
     Field("l_e_delta", 
           ["le_delta", "lbl_e_delta", "label_e_delta", "lbl_ed"],
-          lambda mf, **lbl: lbl["energy"] - mf.energy_tot0(),
+          lambda mf, e_base, **lbl: lbl["energy"] - e_base,
           "(nframe, 1)",
-          ["energy"]),
+          ["energy"],
+          depends=["e_base"]),
     Field("err_e", 
           ["e_err", "err_e_tot", "err_e_cf"],
           lambda mf, **lbl: lbl["energy"] - mf.e_tot,
@@ -163,19 +232,24 @@ SCF_FIELDS.extend([
           "(nframe, natom, nproj, -1)"),
     Field("eg_base",
           ["ele_grad_base", "egrad0", "egrad_base"],
-          lambda mf: mf.get_grad0(),
-          "(nframe, -1)"),
+          lambda mf, fock0: mf.get_grad0(fock=fock0),
+          "(nframe, -1)",
+          depends=["fock0"]),
     # the following one is used for coulomb loss optimization
     Field("grad_ldv",
           ["grad_coul_dv", "grad_coul_deig", "coulomb_grad"], 
-          lambda mf, **lbl: addons.make_grad_coul_veig(mf, target_dm=lbl["dm"]),
+          lambda mf, fock, ovlp, **lbl: addons.make_grad_coul_veig(
+              mf, target_dm=lbl["dm"], fock=fock, ovlp=ovlp),
           "(nframe, natom, nproj)",
-          ["dm"]),
+          ["dm"],
+          depends=["fock", "ovlp"]),
     Field("l_veig_raw",
           ["optim_veig_raw", "l_opt_v_raw", "l_optim_veig_raw"], 
-          lambda mf, **lbl: addons.calc_optim_veig(mf, lbl["dm"], nstep=1),
+          lambda mf, fock0, **lbl: addons.calc_optim_veig(
+              mf, lbl["dm"], nstep=1, fock=fock0),
           "(nframe, natom, nproj)",
-          ["dm"]),
+          ["dm"],
+          depends=["fock0"]),
 ])
 
 GRAD_FIELDS.extend([
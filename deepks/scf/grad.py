@@ -6,7 +6,10 @@ from pyscf import gto, scf, lib
 from pyscf.lib import logger
 from pyscf.grad import rks as rks_grad
 from pyscf.grad import uks as uks_grad
-from deepks.scf.scf import t_make_pdm, t_shell_eig, t_batch_jacobian
+from deepks.scf.scf import t_make_pdm, t_shell_eig, t_make_grad_eig_pdm
+from deepks.scf.scf import t_make_proj_sub, proj_intor_sub, t_ungroup_shells
+from deepks.scf.scf import make_padded_index
+from deepks.scf.scf import t_eig_jacobian, t_make_gedm_groups
 
 # see ./_old_grad.py for a more clear (but maybe slower) implementation
 # all variables and functions start with "t_" are torch related.
@@ -24,6 +27,9 @@ from deepks.scf.scf import t_make_pdm, t_shell_eig, t_batch_jacobian
 #   ipov_shells: [3 x nao x natom x nsph] list
 #   gdmx_shells: [natm (deriv atom) x 3 x natm (proj atom) x nsph x nsph] list
 #   gedm_shells: [natom x nsph x nsph] list
+#   ao_idx: [natom x nsub], ao kept for each projected atom, padded with 0
+#   proj_sub: [natom x nshell x nsph x nsub] list, screened projector by shell size
+#   ipov_sub: [3 x natom x nshell x nsph x nsub] list, same for < \nabla mol_ao |
 
 
 def t_make_grad_e_pdm(model, dm, ovlp_shells):
@@ -38,63 +44,134 @@ def t_make_grad_e_pdm(model, dm, ovlp_shells):
     return gedm_shells
 
 
+def t_ao_atom_index(mol):
+    """return the atom index of each ao, used to sum ao contributions by atom"""
+    aoslice = mol.aoslice_by_atom()
+    return torch.from_numpy(np.repeat(np.arange(mol.natm), aoslice[:,3] - aoslice[:,2]))
+
+
+def t_ao_atom_blocks(mol):
+    """return ao index of each atom, padded to the same length, and its mask"""
+    return make_padded_index([np.arange(bg, ed) for bg, ed in mol.aoslice_by_atom()[:, 2:]])
+
+
+def t_sum_by_atom(mol, ginner, gouter, atmlst):
+    """sum contributions of projected atoms [nratm x 3] and ao [3 x nao] by atom"""
+    ralst = [ii for ii in range(mol.natm) if not mol.elements[ii].startswith("X")]
+    t_ralst = torch.tensor(ralst, dtype=torch.long)
+    gatom = gouter.new_zeros([mol.natm, 3])
+    gatom.index_add_(0, t_ao_atom_index(mol), gouter.T)
+    gatom[t_ralst] += ginner
+    # ghost atoms get nothing
+    rmask = torch.zeros(mol.natm, dtype=torch.bool)
+    rmask[t_ralst] = True
+    gatom[~rmask] = 0
+    return gatom[list(atmlst)]
+
+
 def t_make_grad_pdm_x(mol, dm, ovlp_shells, ipov_shells):
     """return jacobian of projected density matrix w.r.t atomic coordinates"""
     natm = mol.natm
     ralst = [ii for ii in range(mol.natm) if not mol.elements[ii].startswith("X")]
     nratm = len(ralst)
+    t_ralst = torch.tensor(ralst, dtype=torch.long)
+    # ao of each atom as padded blocks, [natm x nblk]
+    blk_idx, blk_mask = t_ao_atom_blocks(mol)
+    blk_mask = blk_mask.to(dm).reshape(*blk_mask.shape, 1, 1)
+    # ghost atoms are not moved by the projection
+    rmask = torch.zeros(natm, dtype=dm.dtype)
+    rmask[t_ralst] = 1
     shell_sec = [ov.shape[-1] for ov in ovlp_shells]
     # [natm (deriv atom) x 3 (xyz) x nratm (proj atom) x nsph (1|3|5) x nsph] list
     gdmx_shells = [torch.zeros([natm, 3, nratm, ss, ss], dtype=float) 
                         for ss in shell_sec]
     for gdmx, govx, ovlp in zip(gdmx_shells, ipov_shells, ovlp_shells):
+        dmov = torch.einsum('rs,saq->raq', dm, ovlp)
         # contribution of projection for all I
-        gproj = torch.einsum('xrap,rs,saq->xapq', govx, dm, ovlp)
-        for ira, ia in enumerate(ralst):
-            bg, ed = mol.aoslice_by_atom()[ia, 2:]
-            # contribution of < \nabla mol_ao |
-            gdmx[ia] -= torch.einsum('xrap,rs,saq->xapq', govx[:,bg:ed], dm[bg:ed], ovlp)
-            # contribution of | \nabla alpha^I_rlm >
-            gdmx[ia,:,ira] += gproj[:, ira]
+        gproj = torch.einsum('xrap,raq->xapq', govx, dmov)
+        # contribution of < \nabla mol_ao |, contracted over ao of each atom
+        # within padded blocks, so no temporary of size nao x gdmx is made
+        gdmx -= torch.einsum('xbrap,braq->bxapq', 
+                             govx[:, blk_idx], dmov[blk_idx] * blk_mask)
+        gdmx *= rmask.reshape(-1, 1, 1, 1, 1)
+        # contribution of | \nabla alpha^I_rlm >
+        gdmx[t_ralst, :, torch.arange(nratm)] += gproj.transpose(0, 1)
         # symmetrize p and q
         gdmx += gdmx.clone().transpose(-1,-2)
     return gdmx_shells
 
 
-def t_make_grad_eig_x(mol, dm, ovlp_shells, ipov_shells):
+def t_make_grad_eig_x(mol, dm, ovlp_shells, ipov_shells, analytic=True, 
+                      eigh_shells=None):
     """return jacobian of decriptor eigenvalues w.r.t atomic coordinates"""
     # v stands for eigen values
-    pdm_shells = [dm.requires_grad_(True) for dm in t_make_pdm(dm, ovlp_shells)]
-    gvdm_shells = [t_batch_jacobian(t_shell_eig, dm, dm.shape[-1]) 
-                        for dm in pdm_shells]
+    # eigh_shells: [(eig, vec)] of projected dm by shells, if already computed
+    if analytic and eigh_shells is not None:
+        gvdm_shells = [t_eig_jacobian(None, eigh=eu) for eu in eigh_shells]
+    else:
+        gvdm_shells = t_make_grad_eig_pdm(t_make_pdm(dm, ovlp_shells), analytic)
     gdmx_shells = t_make_grad_pdm_x(mol, dm, ovlp_shells, ipov_shells)
     gvx_shells = [torch.einsum("bxapq,avpq->bxav", gdmx, gvdm) 
                         for gdmx, gvdm in zip(gdmx_shells, gvdm_shells)]
     return torch.cat(gvx_shells, dim=-1)
 
 
-def t_grad_corr(mol, model, dm, ovlp_shells, ipov_shells, atmlst=None):
+def t_grad_corr(mol, model, dm, ovlp_shells, ipov_shells, atmlst=None, 
+                gedm_shells=None):
     if atmlst is None:
         atmlst = list(range(mol.natm))
     ralst = [ii for ii in range(mol.natm) if not mol.elements[ii].startswith("X")]
-    dec = torch.zeros([len(atmlst), 3], dtype=float)
-    # \partial E / \partial (D^I_rl)_mm' by shells
-    gedm_shells = t_make_grad_e_pdm(model, dm, ovlp_shells)
+    # \partial E / \partial (D^I_rl)_mm' by shells, model is not used if given
+    if gedm_shells is None:
+        gedm_shells = t_make_grad_e_pdm(model, dm, ovlp_shells)
+    # contributions of projection orbitals on each projected atom
+    ginner = dm.new_zeros([len(ralst), 3])
+    # contributions of atomic orbitals on each ao
+    gouter = dm.new_zeros([3, mol.nao])
     for gedm, govx, ovlp in zip(gedm_shells, ipov_shells, ovlp_shells):
-        # contribution of projection orbitals for all atom
-        ginner = torch.einsum('xrap,rs,saq->xapq', govx, dm, ovlp) * 2
-        # contribution of atomic orbitals for all atom
-        gouter = -torch.einsum('xrap,apq,saq->xrs', govx, gedm, ovlp) * 2
-        for k, ia in enumerate(atmlst):
-            if ia not in ralst:
-                continue
-            bg, ed = mol.aoslice_by_atom()[ia, 2:]
-            ira = ralst.index(ia)
-            # contribution of | \nabla alpha^I_rlm > and < \nabla alpha^I_rlm |
-            dec[k] += torch.einsum('xpq,pq->x', ginner[:,ira], gedm[ira])
-            # contribution of < \nabla mol_ao | and | \nabla mol_ao >
-            dec[k] += torch.einsum('xrs,rs->x', gouter[:,bg:ed], dm[bg:ed])
-    return dec
+        dmov = torch.einsum('rs,saq->raq', dm, ovlp)
+        gra = torch.einsum('xrap,raq,apq->xra', govx, dmov, gedm) * 2
+        # contribution of | \nabla alpha^I_rlm > and < \nabla alpha^I_rlm |
+        ginner += gra.sum(1).T
+        # contribution of < \nabla mol_ao | and | \nabla mol_ao >
+        gouter -= gra.sum(2)
+    # sum up ao contributions by atom
+    return t_sum_by_atom(mol, ginner, gouter, atmlst)
+
+
+def t_grad_corr_screened(mol, model, dm, proj_sub, ipov_sub, ao_idx, shell_sec, 
+                         atmlst=None, gedm_groups=None):
+    """same as t_grad_corr, but only uses ao kept for each projected atom"""
+    if atmlst is None:
+        atmlst = list(range(mol.natm))
+    ralst = [ii for ii in range(mol.natm) if not mol.elements[ii].startswith("X")]
+    # dm block seen by each projected atom, [natom x nsub x nsub]
+    dmsub = dm[ao_idx.unsqueeze(-1), ao_idx.unsqueeze(-2)]
+    # \sum_s < alpha^I_rlm | mol_ao_s > D_rs, by shell size
+    dmbra_groups = [(ps.flatten(1, 2) @ dmsub.transpose(-1, -2)).reshape(ps.shape)
+                        for ps in proj_sub]
+    # \partial E / \partial (D^I_rl)_mm' by shell size, model is not used if given
+    if gedm_groups is None:
+        pdm_groups = [(ps @ db.transpose(-1, -2)).requires_grad_(True)
+                            for ps, db in zip(proj_sub, dmbra_groups)]
+        eig_shells = t_ungroup_shells([t_shell_eig(pdm) for pdm in pdm_groups], 
+                                      shell_sec, dim=-2)
+        ceig = torch.cat(eig_shells, dim=-1).unsqueeze(0) # 1 x natoms x nproj
+        _dref = next(model.parameters())
+        ec = model(ceig.to(_dref))
+        gedm_groups = torch.autograd.grad(ec, pdm_groups)
+    ginner = torch.zeros([len(ralst), 3], dtype=float)
+    gouter = torch.zeros([3, mol.nao], dtype=float)
+    for gedm, govx, ovlp, dmbra in zip(gedm_groups, ipov_sub, proj_sub, dmbra_groups):
+        # contribution of | \nabla alpha^I_rlm > and < \nabla alpha^I_rlm |
+        gproj = govx @ dmbra.transpose(-1, -2) * 2
+        ginner += torch.einsum('xakpq,akpq->ax', gproj, gedm)
+        # contribution of < \nabla mol_ao | and | \nabla mol_ao >, by ao
+        gebra = (gedm @ ovlp).flatten(1, 2) @ dmsub.transpose(-1, -2)
+        gao = -(govx.flatten(2, 3) * gebra).sum(-2) * 2
+        gouter.index_add_(1, ao_idx.flatten(), gao.flatten(1))
+    # sum up ao contributions by atom
+    return t_sum_by_atom(mol, ginner, gouter, atmlst)
 
 
 class CorrGradMixin(abc.ABC):
@@ -107,7 +184,8 @@ class CorrGradMixin(abc.ABC):
         de = super().grad_elec(mo_energy, mo_coeff, mo_occ, atmlst)
         cput0 = (time.process_time(), time.perf_counter())
         dec = self.grad_corr(self.base.make_rdm1(mo_coeff, mo_occ), atmlst)
-        logger.timer(self, 'gradients of NN pulay part', *cput0)
+        self.base.add_timing('grad_corr', cput0, 
+            logger.timer(self, 'gradients of NN pulay part', *cput0))
         # memeorize the result to save time in get_base
         self.dec = self.symmetrize(dec, atmlst) if self.mol.symmetry else dec
         return de + dec
@@ -135,14 +213,31 @@ class NetGradMixin(CorrGradMixin):
 
     def prepare_integrals(self):
         mf = self.base
-        # < mol_ao | alpha^I_rlm > by shells
-        self._t_ovlp_shells = mf._t_ovlp_shells
-        # < \nabla mol_ao | alpha^I_rlm >
-        t_proj_ipovlp = torch.from_numpy(mf.proj_intor("int1e_ipovlp")).double()
-        # < \nabla mol_ao | alpha^I_rlm > by shells
-        self._t_ipov_shells = torch.split(
-            t_proj_ipovlp.reshape(3, self.mol.nao, self.base._pmol.natm, -1), 
-            self.base._shell_sec, -1)
+        # dense derivative integrals by shells, see `_t_ipov_shells`
+        self._ipov_shells = None
+        # screened by the same ao blocks as the projector in base
+        # only used in grad_corr, and only when base uses screening
+        self._t_ipov_sub = None
+        if mf._t_ao_idx is not None:
+            t_ipov_sub = torch.from_numpy(proj_intor_sub(
+                self.mol, mf._pmol, "int1e_ipovlp", mf._t_ao_idx, mf._t_ao_mask)).double()
+            self._t_ipov_sub = t_make_proj_sub(t_ipov_sub, mf._t_ao_mask, mf._shell_sec)
+
+    @property
+    def _t_ovlp_shells(self):
+        """< mol_ao | alpha^I_rlm > by shells"""
+        return self.base._t_ovlp_shells
+
+    @property
+    def _t_ipov_shells(self):
+        """< \nabla mol_ao | alpha^I_rlm > by shells, built on first use"""
+        if self._ipov_shells is None:
+            mf = self.base
+            t_proj_ipovlp = torch.from_numpy(mf.proj_intor("int1e_ipovlp")).double()
+            self._ipov_shells = torch.split(
+                t_proj_ipovlp.reshape(3, self.mol.nao, mf._pmol.natm, -1), 
+                mf._shell_sec, -1)
+        return self._ipov_shells
 
     def grad_corr(self, dm=None, atmlst=None):
         """additional contribution of NN "correction" term resulted from projection"""
@@ -155,8 +250,20 @@ class NetGradMixin(CorrGradMixin):
         if dm.ndim > 2: # for uhf case
             dm = dm.sum(0)
         t_dm = torch.from_numpy(dm).double()
-        t_dec = t_grad_corr(self.mol, self.base.net, t_dm, 
-                            self._t_ovlp_shells, self._t_ipov_shells, atmlst)
+        # reuse projection (and network gradient) of the converged dm
+        shell_sec = self.base._shell_sec
+        proj = self.base.get_proj(t_dm)
+        t_gev = self.base.eval_net(self.base.net, proj)[1]
+        t_gedm_groups = t_make_gedm_groups(t_gev, proj["vec"], shell_sec)
+        if self._t_ipov_sub is None:
+            t_dec = t_grad_corr(self.mol, self.base.net, t_dm, 
+                                self._t_ovlp_shells, self._t_ipov_shells, atmlst,
+                                gedm_shells=t_ungroup_shells(t_gedm_groups, shell_sec, dim=-3))
+        else:
+            t_dec = t_grad_corr_screened(self.mol, self.base.net, t_dm, 
+                                self.base._t_proj_bra, self._t_ipov_sub, 
+                                self.base._t_ao_idx, shell_sec, atmlst,
+                                gedm_groups=t_gedm_groups)
         return t_dec.detach().cpu().numpy()
 
     def make_grad_pdm_x(self, dm=None, flatten=False):
@@ -174,15 +281,23 @@ class NetGradMixin(CorrGradMixin):
             return torch.cat([s.flatten(-2) for s in t_gdmx_shells], 
                              dim=-1).detach().cpu().numpy()
 
-    def make_grad_eig_x(self, dm=None):
+    def make_grad_eig_x(self, dm=None, analytic=True):
         """return jacobian of decriptor eigenvalues w.r.t atomic coordinates"""
         if dm is None:
             dm = self.base.make_rdm1()
         if dm.ndim > 2: # for uhf case
             dm = dm.sum(0)
         t_dm = torch.from_numpy(dm).double()
+        # cached eigen decomposition equals the dense one only without screening
+        eigh_shells = None
+        if self.base._t_ao_idx is None:
+            shell_sec = self.base._shell_sec
+            proj = self.base.get_proj(t_dm)
+            eigh_shells = list(zip(t_ungroup_shells(proj["eig"], shell_sec, dim=-2),
+                                   t_ungroup_shells(proj["vec"], shell_sec, dim=-3)))
         t_gvx = t_make_grad_eig_x(self.mol, t_dm, 
-                    self._t_ovlp_shells, self._t_ipov_shells)
+                    self._t_ovlp_shells, self._t_ipov_shells, analytic,
+                    eigh_shells=eigh_shells)
         return t_gvx.detach().cpu().numpy()
 
     def as_scanner(self):
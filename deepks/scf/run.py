@@ -1,16 +1,21 @@
 import os
 import sys
+import csv
+import json
 import time
+import struct
+import multiprocessing as mp
+from functools import partial
 import numpy as np
 import torch
-from pyscf import gto, lib
+from pyscf import gto, scf, lib
 try:
     import deepks
 except ImportError as e:
     sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../../")
 from deepks.scf.scf import DSCF, UDSCF
-from deepks.scf.fields import select_fields
-from deepks.scf.penalty import select_penalty
+from deepks.scf.fields import select_fields, FieldEvaluator
+from deepks.scf.penalty import select_penalty, PenaltyMixin
 from deepks.model.model import CorrNet
 from deepks.utils import check_list, flat_file_list
 from deepks.utils import is_xyz, load_sys_paths
@@ -37,20 +42,96 @@ def solve_mol(mol, model, fields, labels=None,
               proj_basis=None, penalties=None, device=None,
               chkfile=None, verbose=0,
               **scf_args):
-    
+    cf = solve_scf(mol, model, proj_basis=proj_basis, penalties=penalties, 
+                   device=device, chkfile=chkfile, verbose=verbose, **scf_args)
+    return calc_fields(cf, fields, labels)
+
+
+def solve_scf(mol, model, proj_basis=None, penalties=None, device=None,
+              chkfile=None, verbose=0, prev_mf=None, warm_start=False,
+              **scf_args):
+    """
+    build and run the scf solver of mol, return the solver.
+    If prev_mf of the same kind and model is given, it is reset to mol and 
+    reused, so that the geometry independent setups (e.g. the projection
+    basis and shell sections) are kept. With warm_start, the scf starts 
+    from the density matrix of prev_mf if converged (see `guess_from_prev`).
+    """
     tic = time.time()
+    ptic = (time.process_time(), time.perf_counter())
 
     SCFcls = DSCF if mol.spin == 0 else UDSCF
-    cf = SCFcls(mol, model, 
-                proj_basis=proj_basis, 
-                penalties=penalties, 
-                device=device)
+    screen_tol = scf_args.pop("screen_tol", None)
+    net_dtype = scf_args.pop("net_dtype", None)
+    net_tol = scf_args.pop("net_tol", 1e-5)
+    dm0 = None
+    if (prev_mf is not None and type(prev_mf) is SCFcls and prev_mf.net is model
+            and prev_mf.screen_tol == screen_tol 
+            and prev_mf.net_dtype == net_dtype and prev_mf.net_tol == net_tol):
+        if warm_start and prev_mf.converged:
+            dm0 = guess_from_prev(prev_mf, mol)
+        cf = prev_mf.reset(mol)
+        cf.mo_coeff = None
+        PenaltyMixin.__init__(cf, penalties=penalties)
+    else:
+        cf = SCFcls(mol, model, 
+                    proj_basis=proj_basis, 
+                    penalties=penalties, 
+                    device=device,
+                    screen_tol=screen_tol,
+                    net_dtype=net_dtype,
+                    net_tol=net_tol)
     cf.set(chkfile=chkfile, verbose=verbose)
     grid_args = scf_args.pop("grids", {})
     cf.set(**scf_args)
     cf.grids.set(**grid_args)
-    cf.kernel()
+    if cf.callback is None:
+        cf.callback = count_cycle
+    setup = cf.add_timing('setup', ptic)
+    cf.kernel(dm0=dm0)
+    cf.add_timing('scf', setup)
+    if cf.net_check is None:
+        # low precision net is checked once, on the converged dm of first frame
+        cf.check_net_dtype()
+
+    tac = time.time()
+    if verbose:
+        print(f"time of scf: {tac - tic:6.2f}s, converged:   {cf.converged}",
+              "(warm start)" if dm0 is not None else "")
+        if "net_de" in cf.timings:
+            print(f"{net_dtype} net check: energy deviation {cf.timings['net_de']:.2e},",
+                  f"potential deviation {cf.timings['net_dv']:.2e},",
+                  "accepted" if cf.timings["net_accepted"] else "rejected")
+
+    return cf
+
 
+def count_cycle(envs):
+    """callback of scf kernel that records the number of cycles"""
+    envs["mf"].timings["cycles"] = envs["cycle"] + 1
+
+
+def guess_from_prev(prev_mf, mol):
+    """
+    initial dm of mol taken from the converged prev_mf.
+    The dm is used directly if basis is unchanged, otherwise projected 
+    onto the new basis. Return None (default guess) if atoms differ.
+    """
+    prev_mol = prev_mf.mol
+    if (prev_mol.natm != mol.natm
+            or np.any(prev_mol.atom_charges() != mol.atom_charges())):
+        return None
+    dm = prev_mf.make_rdm1()
+    if prev_mol.nao == mol.nao and prev_mol._basis == mol._basis:
+        return dm
+    if dm.ndim == 3:
+        return np.stack([scf.addons.project_dm_nr2nr(prev_mol, d, mol) for d in dm])
+    return scf.addons.project_dm_nr2nr(prev_mol, dm, mol)
+
+
+def calc_fields(cf, fields, labels=None):
+    """calculate meta info and required fields from the converged solver"""
+    mol = cf.mol
     natom_raw = mol.natm
     natom = cf._pmol.natm
     nao = mol.nao
@@ -60,18 +141,21 @@ def solve_mol(mol, model, fields, labels=None,
     res = {}
     if labels is None:
         labels = {}
+    # quantities shared by fields (veff, fock, ...) are computed only once
+    evaluator = FieldEvaluator(cf)
     for fd in fields["scf"]:
-        fls = {k:labels[k] for k in fd.required_labels}
-        res[fd.name] = fd.calc(cf, **fls)
+        tic = (0, time.perf_counter())
+        res[fd.name] = evaluator.calc(fd, labels)
+        cf.add_timing(f'fd_{fd.name}', tic)
     if fields["grad"]:
+        tic = (0, time.perf_counter())
         gd = cf.nuc_grad_method().run()
+        cf.add_timing('grad', tic)
         for fd in fields["grad"]:
             fls = {k:labels[k] for k in fd.required_labels}
+            tic = (0, time.perf_counter())
             res[fd.name] = fd.calc(gd, **fls)
-    
-    tac = time.time()
-    if verbose:
-        print(f"time of scf: {tac - tic:6.2f}s, converged:   {cf.converged}")
+            cf.add_timing(f'fd_{fd.name}', tic)
 
     return meta, res
 
@@ -155,6 +239,24 @@ def build_mol(atom, basis='ccpvdz', unit=DEFAULT_UNIT, verbose=0, **kwargs):
     return mol
 
 
+def move_mol(mol, old_input, new_input):
+    """
+    return a copy of mol moved to the geometry in new_input, if the two
+    inputs of `build_mol` differ only in coordinates; otherwise return None.
+    This avoids parsing basis and building the molecule again.
+    """
+    old_atom, new_atom = old_input["atom"], new_input["atom"]
+    if (isinstance(old_atom, str) or isinstance(new_atom, str)
+            or old_input.keys() != new_input.keys()
+            or any(not np.array_equal(old_input[k], new_input[k]) 
+                   for k in old_input if k != "atom")
+            or len(old_atom) != len(new_atom)
+            or any(str(a[0]) != str(b[0]) for a, b in zip(old_atom, new_atom))):
+        return None
+    coords = np.array([c for e, c in new_atom], dtype=float).reshape(-1, 3)
+    return mol.set_geom_(coords, inplace=False)
+
+
 def build_penalty(pnt_dict, label_dict={}):
     pnt_dict = pnt_dict.copy()
     pnt_type = pnt_dict.pop("type")
@@ -164,23 +266,6 @@ def build_penalty(pnt_dict, label_dict={}):
     return PenaltyClass(*label_arrays, **pnt_dict)
 
 
-def collect_fields(fields, meta, res_list):
-    if isinstance(fields, dict):
-        fields = sum(fields.values(), [])
-    if isinstance(res_list, dict):
-        res_list = [res_list]
-    nframe = len(res_list)
-    natom, natom_raw, nao, nproj = meta
-    res_dict = {}
-    for fd in fields:
-        fd_res = np.array([res[fd.name] for res in res_list])
-        if fd.shape:
-            fd_shape = eval(fd.shape, {}, locals())
-            fd_res = fd_res.reshape(fd_shape)
-        res_dict[fd.name] = fd_res
-    return res_dict
-
-
 def dump_meta(dir_name, meta):
     os.makedirs(dir_name, exist_ok = True)
     np.savetxt(os.path.join(dir_name, 'system.raw'), 
@@ -188,21 +273,189 @@ def dump_meta(dir_name, meta):
                fmt = '%d', header = 'natom natom_raw nao nproj')
 
 
-def dump_data(dir_name, **data_dict):
-    os.makedirs(dir_name, exist_ok = True)
-    for name, value in data_dict.items():
-        np.save(os.path.join(dir_name, f'{name}.npy'), value)
+PROGRESS_FILE = "progress.raw"
+
+
+class FrameWriter(object):
+    """
+    Append fields of each finished frame to npy files under `dir_name`.
+    Every file is kept as a valid npy array holding only the finished frames,
+    and the number of finished frames is recorded in `progress.raw`,
+    so an interrupted calculation can be resumed by skipping them.
+    """
+    def __init__(self, dir_name, fields, resume=False):
+        if isinstance(fields, dict):
+            fields = sum(fields.values(), [])
+        self.dir_name = dir_name
+        self.fields = fields
+        self.meta = None
+        self.nframe = 0
+        self._files = {} # name -> [file, header length, frame shape, dtype]
+        os.makedirs(dir_name, exist_ok = True)
+        if resume:
+            self.resume()
+
+    def resume(self):
+        ppath = os.path.join(self.dir_name, PROGRESS_FILE)
+        mpath = os.path.join(self.dir_name, 'system.raw')
+        if not os.path.exists(ppath) or not os.path.exists(mpath):
+            return
+        nframe = int(np.loadtxt(ppath, dtype=int))
+        fpaths = [os.path.join(self.dir_name, f'{fd.name}.npy') for fd in self.fields]
+        if not all(os.path.exists(fp) for fp in fpaths):
+            print('#', self.dir_name, 'missing fields in finished frames, restart from scratch', 
+                  file=sys.stderr)
+            return
+        self.meta = np.loadtxt(mpath, dtype=int).reshape(-1)
+        for fd, fp in zip(self.fields, fpaths):
+            fobj = open(fp, 'r+b')
+            np.lib.format.read_magic(fobj)
+            shape, _, dtype = np.lib.format.read_array_header_1_0(fobj)
+            hlen = fobj.tell()
+            assert shape[0] >= nframe, f"{fp} has less frames than recorded"
+            fobj.truncate(hlen + nframe * dtype.itemsize * int(np.prod(shape[1:])))
+            self._files[fd.name] = [fobj, hlen, shape[1:], dtype]
+        self.nframe = nframe
+        self._update_headers()
+
+    def write(self, meta, result):
+        if self.meta is None:
+            dump_meta(self.dir_name, meta)
+            self.meta = meta
+        nframe = 1
+        natom, natom_raw, nao, nproj = meta
+        for fd in self.fields:
+            value = np.asarray(result[fd.name])
+            if fd.shape:
+                value = value.reshape(eval(fd.shape, {}, locals())[1:])
+            if fd.name not in self._files:
+                self._open(fd.name, value.shape, value.dtype)
+            fobj, _, fshape, dtype = self._files[fd.name]
+            assert value.shape == fshape, \
+                f"shape of {fd.name} changes from {fshape} to {value.shape}"
+            fobj.seek(0, os.SEEK_END)
+            fobj.write(np.ascontiguousarray(value, dtype=dtype).tobytes())
+        self.nframe += 1
+        self._update_headers()
+        # write the progress last so it never counts a partially written frame
+        ppath = os.path.join(self.dir_name, PROGRESS_FILE)
+        np.savetxt(ppath+".tmp", [self.nframe], fmt='%d', header='nframe_done')
+        os.replace(ppath+".tmp", ppath)
+
+    def close(self):
+        for fobj, *_ in self._files.values():
+            fobj.close()
+        self._files = {}
+
+    def _open(self, name, fshape, dtype):
+        # reserve enough header space for any number of frames
+        hlen = len(self._header(10**15, fshape, dtype))
+        fobj = open(os.path.join(self.dir_name, f'{name}.npy'), 'w+b')
+        self._files[name] = [fobj, hlen, fshape, dtype]
+        fobj.write(self._header(self.nframe, fshape, dtype, hlen))
+
+    def _update_headers(self):
+        for fobj, hlen, fshape, dtype in self._files.values():
+            fobj.seek(0)
+            fobj.write(self._header(self.nframe, fshape, dtype, hlen))
+            fobj.flush()
+
+    @staticmethod
+    def _header(nframe, fshape, dtype, hlen=None):
+        header = repr({'descr': np.lib.format.dtype_to_descr(dtype), 
+                       'fortran_order': False, 
+                       'shape': (nframe, *fshape)})
+        # magic string (6) + version (2) + header length (2) + header + newline
+        if hlen is None:
+            hlen = -(-(11 + len(header)) // 64) * 64
+        header = header.ljust(hlen - 11) + "\n"
+        return (np.lib.format.magic(1, 0) 
+                + struct.pack("<H", len(header)) 
+                + header.encode("latin1"))
+
+
+def sum_timings(system, records, wall_time):
+    """summarize timings and counts of all frame records in a system"""
+    total = {"system": system, "frame": "total", 
+             "nframe": len(records), "t_wall": wall_time}
+    for rec in records:
+        for key, value in rec.items():
+            if key.startswith(("t_", "n_")) or key in ("cycles", "converged"):
+                total[key] = total.get(key, 0) + value
+    return total
+
+
+def dump_timings(file_name, records):
+    """save timing records to a csv file or a json file (other suffixes)"""
+    tmp_name = file_name + ".tmp"
+    with open(tmp_name, "w", newline="") as fp:
+        if file_name.endswith(".csv"):
+            keys = list(dict.fromkeys(k for rec in records for k in rec))
+            writer = csv.DictWriter(fp, keys, restval="")
+            writer.writeheader()
+            writer.writerows(records)
+        else:
+            json.dump(records, fp, indent=1)
+    os.replace(tmp_name, file_name)
+
+
+# per process states used by frame solving, set by `init_solver`
+_SOLVER = {}
+
+
+def init_solver(model_file, dump_fields, penalty_terms=None,
+                nthreads=None, warm_start=False, **solve_args):
+    """load model and fields once per (worker) process for `solve_frame`"""
+    if nthreads is not None:
+        lib.num_threads(nthreads)
+        torch.set_num_threads(nthreads)
+    if model_file is None or model_file.upper() == "NONE":
+        model = None
+    else:
+        model = CorrNet.load(model_file).double()
+    _SOLVER.update(model=model,
+                   fields=select_fields(dump_fields),
+                   penalty_terms=check_list(penalty_terms),
+                   warm_start=warm_start,
+                   solve_args=solve_args,
+                   prev_mf=None,
+                   prev_input=None)
+
+
+def solve_frame(frame):
+    """
+    build and solve one frame given by (mol_input, labels),
+    return meta, field results and timings of the frame
+    """
+    tic = time.perf_counter()
+    mol_input, labels = frame
+    prev_mf = _SOLVER["prev_mf"]
+    mol = None
+    if prev_mf is not None:
+        mol = move_mol(prev_mf.mol, _SOLVER["prev_input"], mol_input)
+    if mol is None:
+        mol = build_mol(**mol_input)
+    penalties = [build_penalty(pd, labels) for pd in _SOLVER["penalty_terms"]]
+    tac = time.perf_counter()
+    cf = solve_scf(mol, _SOLVER["model"], penalties=penalties, 
+                   prev_mf=prev_mf, warm_start=_SOLVER["warm_start"], 
+                   **_SOLVER["solve_args"])
+    # the solver of last frame in this process is reused by the next one
+    _SOLVER.update(prev_mf=cf, prev_input=mol_input)
+    meta, res = calc_fields(cf, _SOLVER["fields"], labels)
+    timings = {"converged": bool(cf.converged), "t_mol": tac - tic, 
+               **cf.timings, "t_frame": time.perf_counter() - tic}
+    return meta, res, timings
 
 
 def main(systems, model_file="model.pth", basis='ccpvdz', 
          proj_basis=None, penalty_terms=None, device=None,
          dump_dir=".", dump_fields=DEFAULT_FNAMES, group=False, 
-         mol_args=None, scf_args=None, verbose=0):
+         mol_args=None, scf_args=None, workers=None, resume=False, 
+         warm_start=False, timing_file=None, verbose=0):
     if model_file is None or model_file.upper() == "NONE":
-        model = None
         default_scf_args = DEFAULT_HF_ARGS
     else:
-        model = CorrNet.load(model_file).double()
         default_scf_args = DEFAULT_SCF_ARGS
 
     # check arguments
@@ -214,53 +467,107 @@ def main(systems, model_file="model.pth", basis='ccpvdz',
     # check label names from label fields and penalties
     label_names = get_required_labels(fields["scf"]+fields["grad"], penalty_terms)
 
+    solver_args = dict(model_file=model_file, dump_fields=dump_fields,
+                       penalty_terms=penalty_terms, warm_start=warm_start,
+                       proj_basis=proj_basis, device=device, verbose=verbose, 
+                       **scf_args)
+    if workers is not None and workers > 1:
+        # split the threads evenly so workers do not oversubscribe cores
+        nthreads = max(1, lib.num_threads() // workers)
+        pool = mp.get_context("spawn").Pool(
+            workers, partial(init_solver, **solver_args, nthreads=nthreads))
+    else:
+        nthreads = lib.num_threads()
+        pool = None
+        init_solver(**solver_args)
+
     if verbose:
-        print(f"starting calculation with OMP threads: {lib.num_threads()}",
+        print(f"starting calculation with OMP threads: {nthreads}",
               f"and max memory: {lib.param.MAX_MEMORY}")
+        if pool is not None:
+            print(f"solving frames with {workers} worker processes")
         if verbose > 1:
             print(f"basis: {basis}")
             print(f"specified scf args:\n  {scf_args}")
 
-    meta = old_meta = None
-    res_list = []
     systems = load_sys_paths(systems)
+    writer = None
+    if group:
+        writer = FrameWriter(dump_dir, fields, resume=resume)
+        nskip = [writer.nframe]
+    meta = old_meta = writer.meta if group else None
+    timing_records = []
 
-    for fl in systems:
-        fl = fl.rstrip(os.path.sep)
+    def frame_iter(fl, nskip):
         for atom, attrs, labels in system_iter(fl, label_names):
-            mol_input = {**mol_args, "verbose":verbose, 
-                        "atom": atom, "basis": basis,  **attrs}
-            mol = build_mol(**mol_input)
-            penalties = [build_penalty(pd, labels) for pd in penalty_terms]
-            try:
-                meta, result = solve_mol(mol, model, fields, labels,
-                                         proj_basis=proj_basis, penalties=penalties,
-                                         device=device, verbose=verbose, **scf_args)
-            except Exception as e:
-                print(fl, 'failed! error:', e, file=sys.stderr)
-                # continue
-                raise
-            if group and old_meta is not None and np.any(meta != old_meta):
+            # skip frames finished in previous runs
+            if nskip[0] > 0:
+                nskip[0] -= 1
+                continue
+            yield ({**mol_args, "verbose": verbose,
+                    "atom": atom, "basis": basis, **attrs}, labels)
+
+    try:
+        for fl in systems:
+            fl = fl.rstrip(os.path.sep)
+            if not group:
+                sub_dir = os.path.join(dump_dir, get_sys_name(os.path.basename(fl)))
+                writer = FrameWriter(sub_dir, fields, resume=resume)
+                nskip = [writer.nframe]
+                meta = writer.meta
+            if verbose and nskip[0] > 0:
+                print(fl, f'resuming, skip {nskip[0]} finished frames')
+            sys_tic = time.perf_counter()
+            sys_records = []
+            nstart = nskip[0]
+            if pool is None:
+                results = map(solve_frame, frame_iter(fl, nskip))
+            else:
+                # each worker gets a contiguous chunk of frames, so it can reuse
+                # (and warm start from) the solver of its previous frame
+                frames = list(frame_iter(fl, nskip))
+                chunksize = max(1, -(-len(frames) // workers))
+                results = pool.imap(solve_frame, frames, chunksize=chunksize)
+            while True:
+                try:
+                    meta, result, timings = next(results)
+                except StopIteration:
+                    break
+                except Exception as e:
+                    print(fl, 'failed! error:', e, file=sys.stderr)
+                    raise
+                if group and old_meta is not None and np.any(meta != old_meta):
+                    break
+                tic = time.perf_counter()
+                writer.write(meta, result)
+                timings["t_io"] = time.perf_counter() - tic
+                # skipped frames are all consumed when the first result comes
+                sys_records.append({"system": fl, 
+                                    "frame": nstart - nskip[0] + len(sys_records),
+                                    "natom": int(meta[1]), "nao": int(meta[2]),
+                                    **timings})
+
+            if timing_file is not None:
+                timing_records.extend(sys_records)
+                timing_records.append(sum_timings(
+                    fl, sys_records, time.perf_counter() - sys_tic))
+                dump_timings(timing_file, timing_records)
+            if not group:
+                writer.close()
+            elif old_meta is not None and np.any(meta != old_meta):
+                print(fl, 'meta does not match! saving previous results only.', file=sys.stderr)
                 break
-            res_list.append(result)
-
-        if not group:
-            sub_dir = os.path.join(dump_dir, get_sys_name(os.path.basename(fl)))
-            dump_meta(sub_dir, meta)
-            dump_data(sub_dir, **collect_fields(fields, meta, res_list))
-            res_list = []
-        elif old_meta is not None and np.any(meta != old_meta):
-            print(fl, 'meta does not match! saving previous results only.', file=sys.stderr)
-            break
-        old_meta = meta
-        if verbose:
-            print(fl, 'finished')
-
-    if group:
-        dump_meta(dump_dir, meta)
-        dump_data(dump_dir, **collect_fields(fields, meta, res_list))
-        if verbose:
-            print('group finished')
+            old_meta = meta
+            if verbose:
+                print(fl, 'finished')
+    finally:
+        if writer is not None:
+            writer.close()
+        if pool is not None:
+            pool.terminate()
+
+    if group and verbose:
+        print('group finished')
 
 
 if __name__ == "__main__":
@@ -1,5 +1,7 @@
 import abc
+import copy
 import time
+import weakref
 import torch
 import numpy as np
 from torch import nn
@@ -12,6 +14,11 @@ from deepks.model.model import CorrNet
 from deepks.scf.penalty import PenaltyMixin
 
 DEVICE = 'cpu'#torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+DEGEN_TOL = 1e-10 # eigenvalues closer than this are treated as degenerate
+PROJ_CACHE_SIZE = 4 # number of dm whose projection is kept in NetMixin
+# results of low precision net checks, by model and then (net_dtype, net_tol),
+# so that the check is done once per model, not once per solver
+_NET_CHECKS = weakref.WeakKeyDictionary()
 
 # all variables and functions start with "t_" are torch based.
 # all variables and functions ends with "0" are original base method results
@@ -20,10 +27,15 @@ DEVICE = 'cpu'#torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 #   a,b: atom
 #   p,q: projected basis on atom
 #   r,s: mol basis in pyscf
+#   k  : shells of the same size on atom
 # parameter shapes:
+#   proj_bra: [(natom x nproj) x nao], rows grouped by shell size
+#   ao_idx: [natom x nsub], ao kept for each projected atom, padded with 0
+#   proj_sub: [natom x nshell x nsph x nsub] list, screened proj_bra by shell size
 #   ovlp_shells: [nao x natom x nsph] list
 #   pdm_shells: [natom x nsph x nsph] list
 #   eig_shells: [natom x nsph] list
+#   pdm_groups: [natom x nshell x nsph x nsph] list, one for each shell size
 
 
 def t_make_pdm(dm, ovlp_shells):
@@ -37,9 +49,13 @@ def t_make_pdm(dm, ovlp_shells):
 if hasattr(torch, "linalg"):
     def t_shell_eig(pdm):
         return torch.linalg.eigvalsh(pdm)
+    def t_shell_eigh(pdm):
+        return torch.linalg.eigh(pdm)
 else:
     def t_shell_eig(pdm):
         return torch.symeig(pdm, eigenvectors=True)[0]
+    def t_shell_eigh(pdm):
+        return torch.symeig(pdm, eigenvectors=True)
 
 
 def t_make_eig(dm, ovlp_shells):
@@ -50,16 +66,235 @@ def t_make_eig(dm, ovlp_shells):
     return ceig
 
 
-def t_get_corr(model, dm, ovlp_shells, with_vc=True):
-    """return the "correction" energy (and potential) given by a NN model"""
-    dm.requires_grad_(True)
-    ceig = t_make_eig(dm, ovlp_shells) # natoms x nproj
+def group_shells(shell_sec):
+    """return distinct shell sizes, their counts and the shell order sorted by size"""
+    sizes = sorted(set(shell_sec))
+    counts = [shell_sec.count(m) for m in sizes]
+    order = sorted(range(len(shell_sec)), key=lambda i: shell_sec[i])
+    return sizes, counts, order
+
+
+def t_ungroup_shells(groups, shell_sec, dim=-2):
+    """split tensors batched by shell size back to shells in original order"""
+    _, _, order = group_shells(list(shell_sec))
+    sorted_shells = [s for g in groups for s in g.unbind(dim)]
+    shells = [None] * len(order)
+    for ish, sh in zip(order, sorted_shells):
+        shells[ish] = sh
+    return shells
+
+
+def t_group_shells(shells, shell_sec, dim=-2):
+    """stack shells of the same size together, inverse of t_ungroup_shells"""
+    sizes, _, order = group_shells(list(shell_sec))
+    return [torch.stack([shells[ish] for ish in order if shell_sec[ish] == m], dim)
+            for m in sizes]
+
+
+def t_make_proj_bra(proj_ovlp, shell_sec):
+    """return < alpha^I_rlm | mol_ao > with rows ordered by shell size, atom, shell and m"""
+    # grouping rows this way makes every shell size group a contiguous block 
+    nao = proj_ovlp.shape[0]
+    shells = torch.split(proj_ovlp, shell_sec, -1)
+    rows = [g.permute(1, 2, 3, 0).reshape(-1, nao)
+            for g in t_group_shells(shells, shell_sec, dim=-2)]
+    return torch.cat(rows, 0)
+
+
+def t_split_proj_bra(proj_bra, shell_sec):
+    """return views of proj_bra by shell size, [natom x nshell x nsph x nao] list"""
+    sizes, counts, _ = group_shells(list(shell_sec))
+    *nbatch, nrow, nao = proj_bra.shape
+    natm = nrow // sum(shell_sec)
+    gsec = [natm * n * m for n, m in zip(counts, sizes)]
+    return [pb.reshape(*nbatch, natm, n, m, nao) 
+            for n, m, pb in zip(counts, sizes, proj_bra.split(gsec, -2))]
+
+
+def make_screen_proj(mol, pmol, threshold):
+    """return ao index, mask and overlap of ao blocks kept for each projected atom
+
+    an ao block (all ao on one atom) is kept if any overlap exceeds threshold.
+    overlaps are computed one projected atom at a time, so that the dense
+    [nao x natom x nproj] overlap is never built. 
+    the overlap of kept ao has shape [natom x nsub x nproj], padded with 0.
+    """
+    cmol = gto.conc_mol(mol, pmol)
+    ao_slices = mol.aoslice_by_atom()[:, 2:]
+    idx_list, sub_list = [], []
+    for ia in range(pmol.natm):
+        ovlp = proj_intor_atom(cmol, mol.nbas, pmol, "int1e_ovlp", ia)
+        idx = np.concatenate([np.arange(bg, ed) for bg, ed in ao_slices 
+                              if ed > bg and np.abs(ovlp[bg:ed]).max() > threshold]
+                             + [np.zeros(0, dtype=int)])
+        idx_list.append(idx)
+        sub_list.append(ovlp[idx])
+    ao_idx, ao_mask = make_padded_index(idx_list)
+    ovlp_sub = np.zeros((*ao_idx.shape, pmol.nao // pmol.natm))
+    for ia, sub in enumerate(sub_list):
+        ovlp_sub[ia, :len(sub)] = sub
+    return ao_idx, ao_mask, ovlp_sub
+
+
+def make_padded_index(idx_list):
+    """stack index arrays of different lengths, padded with 0 and masked"""
+    nsub = max(len(idx) for idx in idx_list)
+    ao_idx = torch.zeros(len(idx_list), nsub, dtype=torch.long)
+    ao_mask = torch.zeros(len(idx_list), nsub, dtype=bool)
+    for ia, idx in enumerate(idx_list):
+        ao_idx[ia, :len(idx)] = torch.as_tensor(idx)
+        ao_mask[ia, :len(idx)] = True
+    return ao_idx, ao_mask
+
+
+def proj_intor_atom(cmol, nbas, pmol, intor, ia, shl_range=None):
+    """integrals between mol ao and projected basis on atom ia of pmol
+
+    cmol is `gto.conc_mol(mol, pmol)` and nbas is the number of shells of mol.
+    only ao shells in shl_range (default all) are computed.
+    """
+    pbg, ped = pmol.aoslice_by_atom()[ia, :2] + nbas
+    sbg, sed = (0, nbas) if shl_range is None else shl_range
+    return cmol.intor(intor, shls_slice=(sbg, sed, pbg, ped))
+
+
+def proj_intor_sub(mol, pmol, intor, ao_idx, ao_mask):
+    """integrals between kept ao and projected basis of each atom
+
+    integrals are computed one projected atom at a time, only over the shells
+    of kept ao blocks. return shape [(comp) x natom x nsub x nproj], padded with 0.
+    """
+    cmol = gto.conc_mol(mol, pmol)
+    aoslice = mol.aoslice_by_atom()
+    ao_atm = np.repeat(np.arange(mol.natm), aoslice[:, 3] - aoslice[:, 2])
+    subs = []
+    for ia, (idx, mask) in enumerate(zip(ao_idx.numpy(), ao_mask.numpy())):
+        blocks = []
+        # kept blocks are sorted by atom, so consecutive atoms form one shell range
+        katm = np.unique(ao_atm[idx[mask]])
+        for run in np.split(katm, np.flatnonzero(np.diff(katm) > 1) + 1):
+            if len(run) == 0:
+                continue
+            shl_range = (aoslice[run[0], 0], aoslice[run[-1], 1])
+            blocks.append(proj_intor_atom(cmol, mol.nbas, pmol, intor, ia, shl_range))
+        subs.append(blocks)
+    pnproj = pmol.nao // pmol.natm
+    ncomp = next((b.shape[:-2] for bl in subs for b in bl), ())
+    out = np.zeros((*ncomp, *ao_idx.shape, pnproj))
+    for ia, blocks in enumerate(subs):
+        if blocks:
+            sub = np.concatenate(blocks, axis=-2)
+            out[..., ia, :sub.shape[-2], :] = sub
+    return out
+
+
+def t_make_proj_sub(ovlp_sub, ao_mask, shell_sec):
+    """return screened < alpha^I_rlm | mol_ao > on kept ao, by shell size"""
+    # ovlp_sub has shape [(batch) x natom x nsub x nproj], rows of kept ao
+    sub = (ovlp_sub * ao_mask.unsqueeze(-1).to(ovlp_sub)).transpose(-1, -2)
+    return t_group_shells(sub.split(shell_sec, -2), shell_sec, dim=-3)
+
+
+def t_make_pdm_fused(dm, proj_bra, shell_sec, ao_idx=None):
+    """return projected density matrix batched by shell size, contracting dm once"""
+    if ao_idx is not None:
+        return t_make_pdm_screened(dm, proj_bra, ao_idx)
+    # the only contraction over full dm, shape [(batch) x (natom x nproj) x nao]
+    dmbra = proj_bra @ dm.transpose(-1, -2)
+    bra_groups = t_split_proj_bra(proj_bra, shell_sec)
+    dmbra_groups = t_split_proj_bra(dmbra, shell_sec)
+    pdm_groups = [pb @ db.transpose(-1, -2)
+                    for pb, db in zip(bra_groups, dmbra_groups)]
+    return pdm_groups
+
+
+def t_make_pdm_screened(dm, proj_sub, ao_idx):
+    """return projected density matrix batched by shell size, using screened ao"""
+    # dm block seen by each projected atom, shape [(batch) x natom x nsub x nsub]
+    dmsub = dm[..., ao_idx.unsqueeze(-1), ao_idx.unsqueeze(-2)]
+    pdm_groups = []
+    for ps in proj_sub:
+        natm, n, m, nsub = ps.shape
+        dmbra = (ps.reshape(natm, n*m, nsub) @ dmsub.transpose(-1, -2))\
+                    .reshape(*dmsub.shape[:-2], n, m, nsub)
+        pdm_groups.append(ps @ dmbra.transpose(-1, -2))
+    return pdm_groups
+
+
+def t_make_eigh_fused(dm, proj_bra, shell_sec, ao_idx=None):
+    """return projected density matrix, its eigenvalues and eigenvectors by shell size"""
+    with torch.no_grad():
+        pdm_groups = t_make_pdm_fused(dm, proj_bra, shell_sec, ao_idx)
+        eig_groups, vec_groups = zip(*[t_shell_eigh(pdm) for pdm in pdm_groups])
+    return pdm_groups, list(eig_groups), list(vec_groups)
+
+
+def t_make_eig_fused(dm, proj_bra, shell_sec, ao_idx=None):
+    """return eigenvalues of projected density matrix, batched by shell size"""
+    pdm_groups = t_make_pdm_fused(dm, proj_bra, shell_sec, ao_idx)
+    eig_groups = [t_shell_eig(pdm) for pdm in pdm_groups]
+    ceig = torch.cat(t_ungroup_shells(eig_groups, shell_sec, dim=-2), dim=-1)
+    return ceig
+
+
+def t_make_gedm_groups(gev, vec_groups, shell_sec):
+    """return gradient of energy w.r.t. projected dm, batched by shell size"""
+    # dE / dD^I = U diag(dE / de) U^T, batched by shell size
+    gev_groups = t_group_shells(gev.split(shell_sec, -1), shell_sec, dim=-2)
+    return [(u * g.unsqueeze(-2)) @ u.transpose(-1, -2) 
+            for u, g in zip(vec_groups, gev_groups)]
+
+
+def t_make_vc_fused(gev, vec_groups, proj_bra, shell_sec, ao_idx=None, nao=None):
+    """return correction potential given gradient of energy w.r.t. eigenvalues"""
+    gedm_groups = t_make_gedm_groups(gev, vec_groups, shell_sec)
+    if ao_idx is not None:
+        return t_make_vc_screened(gedm_groups, proj_bra, ao_idx, nao)
+    # V_rs = \sum_I < mol_ao_r | alpha^I_p > (dE / dD^I)_pq < alpha^I_q | mol_ao_s >
+    nao = proj_bra.shape[-1]
+    vc = sum(pb.reshape(-1, nao).T @ (gd @ pb).reshape(-1, nao)
+                for pb, gd in zip(t_split_proj_bra(proj_bra, shell_sec), gedm_groups))
+    return vc
+
+
+def t_make_vc_screened(gedm_groups, proj_sub, ao_idx, nao):
+    """return correction potential from dE / dD^I, using screened ao"""
+    vsub = 0.
+    for ps, gd in zip(proj_sub, gedm_groups):
+        natm, n, m, nsub = ps.shape
+        vsub = vsub + (ps.reshape(natm, n*m, nsub).transpose(-1, -2)
+                       @ (gd @ ps).reshape(natm, n*m, nsub))
+    # padded ao have zero projection so they add nothing to vc
+    vc = vsub.new_zeros(nao, nao).index_put_(
+        (ao_idx.unsqueeze(-1), ao_idx.unsqueeze(-2)), vsub, accumulate=True)
+    return vc
+
+
+def t_eval_net(model, ceig, with_grad=True):
+    """return energy given by a NN model (and its gradient w.r.t. eigenvalues)"""
     _dref = next(model.parameters()) if isinstance(model, nn.Module) else DEVICE
-    ec = model(ceig.to(_dref))  # no batch dim here, unsqueeze(0) if needed
+    if not with_grad:
+        with torch.no_grad():
+            ec = model(ceig.to(_dref))
+        return ec.to(ceig), None
+    t_eig = ceig.to(_dref).detach().requires_grad_(True) # natoms x nproj
+    ec = model(t_eig)  # no batch dim here, unsqueeze(0) if needed
+    [gev] = torch.autograd.grad(ec, t_eig, torch.ones_like(ec))
+    return ec.detach().to(ceig), gev.to(ceig)
+
+
+def t_get_corr(model, dm, proj_bra, shell_sec, with_vc=True, ao_idx=None):
+    """return the "correction" energy (and potential) given by a NN model"""
+    # projection and eigen decomposition are done without autograd
+    # the potential is assembled in closed form from the eigenvectors
+    pdm_groups, eig_groups, vec_groups = t_make_eigh_fused(dm, proj_bra, shell_sec, ao_idx)
+    ceig = torch.cat(t_ungroup_shells(eig_groups, shell_sec, dim=-2), dim=-1)
+    ec, gev = t_eval_net(model, ceig, with_grad=with_vc)
     if not with_vc:
-        return ec.to(ceig)
-    [vc] = torch.autograd.grad(ec, dm, torch.ones_like(ec))
-    return ec.to(ceig), vc
+        return ec
+    vc = t_make_vc_fused(gev, vec_groups, proj_bra, shell_sec, 
+                         ao_idx, nao=dm.shape[-1])
+    return ec, vc
 
 
 def t_batch_jacobian(f, x, noutputs):
@@ -73,21 +308,47 @@ def t_batch_jacobian(f, x, noutputs):
     return torch.autograd.grad(y, x, input_val)[0]
 
 
-def t_make_grad_eig_dm(dm, ovlp_shells):
+def t_eig_jacobian(pdm, degen_tol=DEGEN_TOL, eigh=None):
+    """return jacobian of eigenvalues w.r.t. symmetric matrix in closed form"""
+    # d e_v / d D_pq = U_pv U_qv for non-degenerate eigenvalues.
+    # eigenvalues within degen_tol are averaged, so that the jacobian 
+    # uses the projector of the degenerate subspace and is basis independent
+    # eigh = (e, u) of pdm can be given if already computed
+    e, u = t_shell_eigh(pdm) if eigh is None else eigh
+    degen = ((e.unsqueeze(-1) - e.unsqueeze(-2)).abs() < degen_tol).to(u)
+    wgt = degen / degen.sum(-1, keepdim=True)
+    return torch.einsum('...pw,...vw,...qw->...vpq', u, wgt, u)
+
+
+def t_make_grad_eig_pdm(pdm_shells, analytic=True):
+    """return jacobian of eigenvalues w.r.t projected density matrix by shells"""
+    if analytic:
+        return [t_eig_jacobian(dm.detach()) for dm in pdm_shells]
+    pdm_shells = [dm.requires_grad_(True) for dm in pdm_shells]
+    return [t_batch_jacobian(t_shell_eig, dm, dm.shape[-1]) 
+                for dm in pdm_shells]
+
+
+def t_make_grad_eig_dm(dm, ovlp_shells, analytic=True):
     """return jacobian of decriptor eigenvalues w.r.t 1-rdm"""
     # using the sparsity, much faster than naive torch version
     # v stands for eigen values
-    pdm_shells = [dm.requires_grad_(True) for dm in t_make_pdm(dm, ovlp_shells)]
-    gvdm_shells = [t_batch_jacobian(t_shell_eig, dm, dm.shape[-1]) 
-                        for dm in pdm_shells]
+    gvdm_shells = t_make_grad_eig_pdm(t_make_pdm(dm, ovlp_shells), analytic)
     vjac_shells = [torch.einsum('rap,avpq,saq->avrs', po, gdm, po)
                         for po, gdm in zip(ovlp_shells, gvdm_shells)]
     return torch.cat(vjac_shells, dim=1)
 
 
-def gen_proj_mol(mol, basis) :
+def gen_proj_mol(mol, basis, pmol=None) :
     mole_coords = mol.atom_coords(unit="Ang")
     mole_ele = mol.elements
+    if pmol is not None:
+        # reuse the built projection mol, only update the geometry
+        # so that the basis need not to be parsed again
+        coords = np.array([coord for coord, ele in zip(mole_coords, mole_ele)
+                           if not ele.startswith("X")]).reshape(-1, 3)
+        if len(coords) == pmol.natm:
+            return pmol.set_geom_(coords, unit="Ang", inplace=False)
     test_mol = gto.Mole()
     test_mol.atom = [["X", coord] for coord, ele in zip(mole_coords, mole_ele)
                      if not ele.startswith("X")]
@@ -102,11 +363,11 @@ class CorrMixin(abc.ABC):
     def get_veff0(self, *args, **kwargs):
         return super().get_veff(*args, **kwargs)
     
-    def get_grad0(self, mo_coeff=None, mo_occ=None):
+    def get_grad0(self, mo_coeff=None, mo_occ=None, fock=None):
         if mo_occ is None: mo_occ = self.mo_occ
         if mo_coeff is None: mo_coeff = self.mo_coeff
-        return super().get_grad(mo_coeff, mo_occ, 
-                                fock=self.get_fock(vhf=self.get_veff0()))
+        if fock is None: fock = self.get_fock(vhf=self.get_veff0())
+        return super().get_grad(mo_coeff, mo_occ, fock=fock)
 
     def energy_elec0(self, dm=None, h1e=None, vhf=None):
         if vhf is None: vhf = self.get_veff0(dm=dm)
@@ -128,10 +389,10 @@ class CorrMixin(abc.ABC):
         # base method part
         v0_last = getattr(vhf_last, 'v0', 0)
         v0 = self.get_veff0(mol, dm, dm_last, v0_last, hermi)
-        tic = logger.timer(self, 'v0', *tic)
+        tic = self.add_timing('veff0', tic, logger.timer(self, 'v0', *tic))
         # Correlation (or correction) part
         ec, vc = self.get_corr(dm)
-        tic = logger.timer(self, 'vc', *tic)
+        tic = self.add_timing('corr', tic, logger.timer(self, 'vc', *tic))
         # make total effective potential
         vtot = v0 + vc
         vtot = lib.tag_array(vtot, ec=ec, v0=v0)
@@ -150,6 +411,15 @@ class CorrMixin(abc.ABC):
         logger.debug(self, f'Emodel = {ec}')
         return (etot+ec).real, e2+ec
 
+    def add_timing(self, name, tic, toc=None):
+        """accumulate wall time and number of calls of a phase into timings"""
+        if toc is None:
+            toc = (time.process_time(), time.perf_counter())
+        timings = self.__dict__.setdefault("timings", {})
+        timings[f"t_{name}"] = timings.get(f"t_{name}", 0.) + toc[1] - tic[1]
+        timings[f"n_{name}"] = timings.get(f"n_{name}", 0) + 1
+        return toc
+
     @abc.abstractmethod
     def get_corr(self, dm=None):
         """return "correction" energy and corresponding potential"""
@@ -165,15 +435,40 @@ class CorrMixin(abc.ABC):
 class NetMixin(CorrMixin):
     """Mixin class to add correction term given by a neural network model"""
 
-    def __init__(self, model, proj_basis=None, device=DEVICE):
+    def __init__(self, model, proj_basis=None, device=DEVICE, screen_tol=None,
+                 net_dtype=None, net_tol=1e-5):
         # make sure you call this method after the base SCF class init
         # otherwise it would throw an error due to the lack of mol attr
         self.device = device
+        # accumulated time and counts of each phase, see `add_timing`
+        self.timings = {}
+        # projection and eigen decomposition of last few dm, see `get_proj`
+        self._proj_cache = []
+        # ao blocks with projector overlap below screen_tol are dropped
+        # in the fused projection. None means no screening (dense projector)
+        self.screen_tol = screen_tol
         if isinstance(model, str):
             model = CorrNet.load(model).double()
         if isinstance(model, torch.nn.Module):
             model = model.to(self.device).eval()
         self.net = model
+        # optionally evaluate the network (only) in lower precision, like float32
+        # projection, eigen solver and potential assembly are kept in float64
+        # float64 is used until the low precision net is checked against it on
+        # a converged dm (see `check_net_dtype`, called by `run.solve_scf` after
+        # the first frame), and it is dropped if the deviation exceeds net_tol
+        self.net_dtype = net_dtype
+        self.net_tol = net_tol
+        self.net_check = None
+        self._net_low = None
+        if net_dtype is not None and isinstance(model, torch.nn.Module):
+            if isinstance(net_dtype, str):
+                net_dtype = getattr(torch, net_dtype)
+            # reuse the decision made by an earlier solver of the same model
+            self._net_key = (net_dtype, net_tol)
+            self.net_check = _NET_CHECKS.get(model, {}).get(self._net_key)
+            if self.net_check is None or self.net_check["net_accepted"]:
+                self._net_low = copy.deepcopy(model).to(net_dtype)
         # try load basis from model file
         if proj_basis is None:
             proj_basis = getattr(model, "_pbas", None)
@@ -187,12 +482,45 @@ class NetMixin(CorrMixin):
         self.prepare_integrals()
 
     def prepare_integrals(self):
-        # a virtual molecule to be projected on
-        self._pmol = gen_proj_mol(self.mol, self._pbas)
-        # < mol_ao | alpha^I_rlm >, shape=[nao x natom x nproj]
-        t_proj_ovlp = torch.from_numpy(self.proj_ovlp()).double()
-        # split the projected coeffs by shell (different r and l)
-        self._t_ovlp_shells = torch.split(t_proj_ovlp, self._shell_sec, -1)
+        self._proj_cache = []
+        # a virtual molecule to be projected on, only moved if exists
+        self._pmol = gen_proj_mol(self.mol, self._pbas, getattr(self, "_pmol", None))
+        # dense projector split by shells, see `_t_ovlp_shells`
+        self._ovlp_shells = None
+        self._t_ao_idx = self._t_ao_mask = None
+        if self.screen_tol is None:
+            # < mol_ao | alpha^I_rlm >, shape=[nao x natom x nproj]
+            t_proj_ovlp = torch.from_numpy(self.proj_ovlp()).double()
+            # transposed and grouped by shell size, used in fused projection
+            self._t_proj_bra = t_make_proj_bra(t_proj_ovlp, self._shell_sec)
+        else:
+            # screened projector replaces the dense one in the fused projection
+            # only overlaps of ao blocks kept for each projected atom are stored
+            self._t_ao_idx, self._t_ao_mask, ovlp_sub = make_screen_proj(
+                self.mol, self._pmol, self.screen_tol)
+            self._t_proj_bra = t_make_proj_sub(
+                torch.from_numpy(ovlp_sub).double(), self._t_ao_mask, self._shell_sec)
+
+    @property
+    def _t_ovlp_shells(self):
+        """< mol_ao | alpha^I_rlm > by shell, [nao x natom x nsph] list
+
+        without screening these are views of the dense proj_bra. with screening,
+        the dense projector is only built here for callers that need it 
+        (addons, jacobians of descriptors) and kept until integrals are reset.
+        """
+        if self._ovlp_shells is None:
+            proj_bra = self._t_proj_bra
+            if self._t_ao_idx is not None:
+                proj_bra = t_make_proj_bra(
+                    torch.from_numpy(self.proj_ovlp()).double(), self._shell_sec)
+            # split the projected coeffs by shell (different r and l)
+            # as views of proj_bra so that only one copy is kept in memory
+            self._ovlp_shells = t_ungroup_shells(
+                [g.permute(3, 0, 1, 2) 
+                    for g in t_split_proj_bra(proj_bra, self._shell_sec)],
+                self._shell_sec, dim=-2)
+        return self._ovlp_shells
 
     def get_corr(self, dm=None):
         """return "correction" energy and corresponding potential"""
@@ -204,18 +532,91 @@ class NetMixin(CorrMixin):
         if dm.ndim >= 3 and isinstance(self, scf.uhf.UHF):
             dm = dm.sum(0)
         t_dm = torch.from_numpy(dm).double()
-        t_ec, t_vc = t_get_corr(self.net, t_dm, self._t_ovlp_shells, with_vc=True)
+        t_ec, t_vc = self.t_get_corr(self.get_net(), t_dm)
         ec = t_ec.item() if t_ec.nelement()==1 else t_ec.detach().cpu().numpy()
         vc = t_vc.detach().cpu().numpy()
-        ec = ec + self.net.get_elem_const(filter(None, self.mol.atom_charges()))
+        ec = ec + self.net.get_elem_const([int(z) for z in self.mol.atom_charges() if z])
         return ec, vc
 
+    def get_net(self):
+        """return the low precision net if it has passed the check, else float64 one"""
+        if self._net_low is not None and self.net_check is not None:
+            return self._net_low
+        return self.net
+
+    def check_net_dtype(self, dm=None):
+        """compare correction of the low precision net with float64 one on given dm
+
+        dm should be converged (default the current one). the low precision 
+        net is used afterwards if the deviation is within net_tol, and dropped 
+        otherwise. return the check result, None if there is no net to check.
+        """
+        if self._net_low is None:
+            return None
+        if dm is None:
+            dm = self.make_rdm1()
+        dm = np.asanyarray(dm)
+        if dm.ndim >= 3 and isinstance(self, scf.uhf.UHF):
+            dm = dm.sum(0)
+        t_dm = torch.from_numpy(dm).double()
+        t_ec, t_vc = self.t_get_corr(self.net, t_dm)
+        t_ec1, t_vc1 = self.t_get_corr(self._net_low, t_dm)
+        de = (t_ec1 - t_ec).abs().max().item()
+        dv = (t_vc1 - t_vc).abs().max().item()
+        accepted = max(de, dv) <= self.net_tol
+        self.net_check = {"net_de": de, "net_dv": dv, "net_accepted": accepted}
+        _NET_CHECKS.setdefault(self.net, {})[self._net_key] = self.net_check
+        self.timings.update(self.net_check)
+        msg = (f"{self.net_dtype} net deviates from float64 by {de:.2e} in energy "
+               f"and {dv:.2e} in potential, ")
+        if accepted:
+            logger.info(self, msg + "accepted")
+        else:
+            logger.warn(self, msg + f"rejected (net_tol = {self.net_tol:.1e})")
+            self._net_low = None
+        return self.net_check
+
+    def t_get_corr(self, net, t_dm):
+        """same as `t_get_corr`, using the cached projection of t_dm"""
+        proj = self.get_proj(t_dm)
+        t_ec, t_gev = self.eval_net(net, proj)
+        t_vc = t_make_vc_fused(t_gev, proj["vec"], self._t_proj_bra, self._shell_sec, 
+                               self._t_ao_idx, nao=t_dm.shape[-1])
+        return t_ec, t_vc
+
+    def get_proj(self, t_dm):
+        """return projected dm, eigen decomposition and descriptors of a 2d dm
+
+        results of the last few dm are cached, and looked up by the values of dm
+        since pyscf makes a new dm array on every `make_rdm1` call. fields and 
+        gradients of the converged dm then reuse those of the last scf cycle.
+        """
+        for ii, proj in enumerate(self._proj_cache):
+            if torch.equal(proj["dm"], t_dm):
+                self._proj_cache.insert(0, self._proj_cache.pop(ii))
+                return proj
+        pdm_groups, eig_groups, vec_groups = t_make_eigh_fused(
+            t_dm, self._t_proj_bra, self._shell_sec, self._t_ao_idx)
+        ceig = torch.cat(t_ungroup_shells(eig_groups, self._shell_sec, dim=-2), dim=-1)
+        proj = {"dm": t_dm.clone(), "pdm": pdm_groups, "eig": eig_groups, 
+                "vec": vec_groups, "ceig": ceig, "net": {}}
+        self._proj_cache = [proj] + self._proj_cache[:PROJ_CACHE_SIZE-1]
+        return proj
+
+    def eval_net(self, net, proj):
+        """return energy and its gradient w.r.t. eigenvalues of a cached projection"""
+        # keyed by id since the float64 and low precision nets may both be used
+        if id(net) not in proj["net"]:
+            proj["net"][id(net)] = t_eval_net(net, proj["ceig"])
+        return proj["net"][id(net)]
+
     def nuc_grad_method(self):
         from deepks.scf.grad import build_grad
         return build_grad(self)
 
     def reset(self, mol=None):
         super().reset(mol)
+        self.timings = {}
         self.prepare_integrals()
         return self
 
@@ -224,7 +625,12 @@ class NetMixin(CorrMixin):
         if dm is None:
             dm = self.make_rdm1()
         t_dm = torch.from_numpy(dm).double()
-        t_pdm_shells = t_make_pdm(t_dm, self._t_ovlp_shells)
+        if t_dm.ndim == 2:
+            t_pdm_groups = self.get_proj(t_dm)["pdm"]
+        else:
+            t_pdm_groups = t_make_pdm_fused(t_dm, self._t_proj_bra, self._shell_sec, 
+                                            self._t_ao_idx)
+        t_pdm_shells = t_ungroup_shells(t_pdm_groups, self._shell_sec, dim=-3)
         if not flatten:
             return [s.detach().cpu().numpy() for s in t_pdm_shells]
         else:
@@ -239,7 +645,11 @@ class NetMixin(CorrMixin):
         if dm.ndim >= 3 and isinstance(self, scf.uhf.UHF):
             dm = dm.sum(0)
         t_dm = torch.from_numpy(dm).double()
-        t_eig = t_make_eig(t_dm, self._t_ovlp_shells)
+        if t_dm.ndim == 2:
+            t_eig = self.get_proj(t_dm)["ceig"]
+        else:
+            t_eig = t_make_eig_fused(t_dm, self._t_proj_bra, self._shell_sec, 
+                                     self._t_ao_idx)
         return t_eig.detach().cpu().numpy()
 
     def proj_intor(self, intor):
@@ -265,11 +675,13 @@ class NetMixin(CorrMixin):
 class DSCF(NetMixin, PenaltyMixin, dft.rks.RKS):
     """Restricted SCF solver for given NN energy model"""
     
-    def __init__(self, mol, model, xc="HF", proj_basis=None, penalties=None, device=DEVICE):
+    def __init__(self, mol, model, xc="HF", proj_basis=None, penalties=None, 
+                 device=DEVICE, screen_tol=None, net_dtype=None, net_tol=1e-5):
         # base method must be initialized first
         dft.rks.RKS.__init__(self, mol, xc=xc)
         # correction mixin initialization
-        NetMixin.__init__(self, model, proj_basis=proj_basis, device=device)
+        NetMixin.__init__(self, model, proj_basis=proj_basis, device=device, 
+                          screen_tol=screen_tol, net_dtype=net_dtype, net_tol=net_tol)
         # penalty term initialization
         PenaltyMixin.__init__(self, penalties=penalties)
         # update keys to avoid pyscf warning
@@ -281,11 +693,13 @@ DeepSCF = RDSCF = DSCF
 class UDSCF(NetMixin, PenaltyMixin, dft.uks.UKS):
     """Unrestricted SCF solver for given NN energy model"""
     
-    def __init__(self, mol, model, xc="HF", proj_basis=None, penalties=None, device=DEVICE):
+    def __init__(self, mol, model, xc="HF", proj_basis=None, penalties=None, 
+                 device=DEVICE, screen_tol=None, net_dtype=None, net_tol=1e-5):
         # base method must be initialized first
         dft.uks.UKS.__init__(self, mol, xc=xc)
         # correction mixin initialization
-        NetMixin.__init__(self, model, proj_basis=proj_basis, device=device)
+        NetMixin.__init__(self, model, proj_basis=proj_basis, device=device, 
+                          screen_tol=screen_tol, net_dtype=net_dtype, net_tol=net_tol)
         # penalty term initialization
         PenaltyMixin.__init__(self, penalties=penalties)
         # update keys to avoid pyscf warning
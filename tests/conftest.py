@@ -0,0 +1,50 @@
+import pytest
+import torch
+import numpy as np
+from pyscf import gto, scf
+from deepks.utils import get_shell_sec
+from deepks.model.model import CorrNet
+from deepks.scf.scf import DSCF
+
+# small water molecule, one distorted so no two atoms are equivalent
+H2O = "O 0 0 0; H 0 0.76 0.58; H 0 -0.77 0.61"
+
+
+def make_model(seed=0, **kwargs):
+    """a random CorrNet on descriptors of the default projection basis"""
+    torch.manual_seed(seed)
+    nproj = sum(get_shell_sec(None))
+    model = CorrNet(nproj, **{"hidden_sizes": (8, 8), **kwargs})
+    model.set_normalization(np.full(nproj, 0.1), np.full(nproj, 0.5))
+    return model.eval()
+
+
+@pytest.fixture(scope="session")
+def mol():
+    return gto.M(atom=H2O, basis="sto-3g", verbose=0)
+
+
+@pytest.fixture(scope="session")
+def ghost_mol():
+    """water with a ghost atom, which has ao but no projection"""
+    return gto.M(atom=H2O + "; X-H 1.2 1.5 0.3", basis="sto-3g", verbose=0)
+
+
+@pytest.fixture(scope="session")
+def model():
+    return make_model()
+
+
+@pytest.fixture(scope="session")
+def dm(mol):
+    return scf.RHF(mol).run().make_rdm1()
+
+
+@pytest.fixture(scope="session")
+def ghost_dm(ghost_mol):
+    return scf.RHF(ghost_mol).run().make_rdm1()
+
+
+@pytest.fixture
+def mf(mol, model):
+    return DSCF(mol, model)
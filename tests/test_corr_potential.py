@@ -0,0 +1,32 @@
+import pytest
+import torch
+import numpy as np
+from deepks.scf.scf import DSCF, t_make_eig, t_get_corr
+from conftest import make_model
+
+
+def autograd_corr(model, dm, ovlp_shells):
+    """energy and potential by differentiating through the eigen solver"""
+    dm = dm.clone().requires_grad_(True)
+    ec = model(t_make_eig(dm, ovlp_shells))
+    [vc] = torch.autograd.grad(ec, dm, torch.ones_like(ec))
+    return ec.detach(), vc
+
+
+@pytest.fixture(scope="module", params=[None, "thermal", "trace"])
+def any_model(request):
+    return make_model(embedding=request.param)
+
+
+def test_closed_form_vc(mol, dm, any_model):
+    mf = DSCF(mol, any_model)
+    t_dm = torch.from_numpy(dm).double()
+    ec, vc = t_get_corr(any_model, t_dm, mf._t_proj_bra, mf._shell_sec)
+    ec0, vc0 = autograd_corr(any_model, t_dm, mf._t_ovlp_shells)
+    assert torch.allclose(ec, ec0, atol=1e-12)
+    assert torch.allclose(vc, vc.T, atol=1e-12)
+    assert torch.allclose(vc, (vc0 + vc0.T) / 2, atol=1e-10)
+    # same through the scf object, with cached projection
+    ec1, vc1 = mf.get_corr(dm)
+    assert ec1 == pytest.approx(ec.item(), abs=1e-12)
+    assert np.allclose(vc1, vc.numpy(), atol=1e-12)
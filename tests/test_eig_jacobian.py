@@ -0,0 +1,59 @@
+import torch
+from deepks.scf.scf import DEGEN_TOL
+from deepks.scf.scf import t_make_pdm, t_shell_eig, t_eig_jacobian
+from deepks.scf.scf import t_make_grad_eig_pdm, t_make_grad_eig_dm
+
+
+def degen_sum(jac, eig, tol=DEGEN_TOL):
+    """sum jacobian rows [... x v x p x q] over degenerate eigenvalues [... x v]
+
+    autograd rows of degenerate eigenvalues depend on the eigenvectors picked,
+    only their sum (the projector of the subspace) is well defined.
+    """
+    jac = jac.reshape(-1, *jac.shape[-3:])
+    eig = eig.detach().reshape(-1, eig.shape[-1])
+    sums = []
+    for jj, ee in zip(jac, eig):
+        bounds = [0, *(torch.nonzero(ee.diff() >= tol).flatten() + 1).tolist(), len(ee)]
+        for bg, ed in zip(bounds[:-1], bounds[1:]):
+            # clusters are compact, so analytic jacobian averages within them
+            assert ee[ed-1] - ee[bg] < tol
+            sums.append(jj[bg:ed].sum(0))
+    return torch.stack(sums)
+
+
+def test_grad_eig_pdm(mf, dm):
+    t_dm = torch.from_numpy(dm).double()
+    pdm_shells = t_make_pdm(t_dm, mf._t_ovlp_shells)
+    analytic = t_make_grad_eig_pdm(pdm_shells, analytic=True)
+    autograd = t_make_grad_eig_pdm(pdm_shells, analytic=False)
+    for pdm, ga, gb in zip(pdm_shells, analytic, autograd):
+        assert ga.shape == gb.shape
+        # autograd splits off-diagonal elements unevenly between p,q and q,p
+        gb = (gb + gb.transpose(-1, -2)) / 2
+        eig = t_shell_eig(pdm)
+        assert torch.allclose(degen_sum(ga, eig), degen_sum(gb, eig), atol=1e-10)
+
+
+def test_grad_eig_dm(mf, dm):
+    t_dm = torch.from_numpy(dm).double()
+    ovlp_shells = mf._t_ovlp_shells
+    analytic = t_make_grad_eig_dm(t_dm, ovlp_shells, analytic=True)
+    autograd = t_make_grad_eig_dm(t_dm, ovlp_shells, analytic=False)
+    autograd = (autograd + autograd.transpose(-1, -2)) / 2
+    sec = [ov.shape[-1] for ov in ovlp_shells]
+    eig_shells = [t_shell_eig(pdm) for pdm in t_make_pdm(t_dm, ovlp_shells)]
+    for ga, gb, eig in zip(analytic.split(sec, 1), autograd.split(sec, 1), eig_shells):
+        assert torch.allclose(degen_sum(ga, eig), degen_sum(gb, eig), atol=1e-10)
+
+
+def test_degenerate_jacobian():
+    # two degenerate eigenvalues share the projector onto their subspace
+    torch.manual_seed(0)
+    u = torch.linalg.qr(torch.randn(3, 3, dtype=torch.float64))[0]
+    pdm = u @ torch.diag(torch.tensor([1., 1., 2.], dtype=torch.float64)) @ u.T
+    jac = t_eig_jacobian(pdm)
+    proj = u[:, :2] @ u[:, :2].T / 2
+    assert torch.allclose(jac[0], proj, atol=1e-10)
+    assert torch.allclose(jac[1], proj, atol=1e-10)
+    assert torch.allclose(jac[2], torch.outer(u[:, 2], u[:, 2]), atol=1e-10)
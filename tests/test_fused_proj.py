@@ -0,0 +1,40 @@
+import torch
+from deepks.scf.scf import t_make_pdm, t_make_eig, t_ungroup_shells
+from deepks.scf.scf import t_make_pdm_fused, t_make_eig_fused
+
+
+def dense_ovlp_shells(mf):
+    """per shell projector built directly from the overlap, as before fusing"""
+    t_proj_ovlp = torch.from_numpy(mf.proj_ovlp()).double()
+    return torch.split(t_proj_ovlp, mf._shell_sec, -1)
+
+
+def batch_dm(dm):
+    t_dm = torch.from_numpy(dm).double()
+    return torch.stack([t_dm, 0.8 * t_dm + 0.01 * t_dm @ t_dm])
+
+
+def test_fused_pdm(mf, dm):
+    t_dm = batch_dm(dm)
+    pdm_groups = t_make_pdm_fused(t_dm, mf._t_proj_bra, mf._shell_sec)
+    fused = t_ungroup_shells(pdm_groups, mf._shell_sec, dim=-3)
+    shells = t_make_pdm(t_dm, dense_ovlp_shells(mf))
+    assert len(fused) == len(shells)
+    for pf, ps in zip(fused, shells):
+        assert pf.shape == ps.shape
+        assert torch.allclose(pf, ps, atol=1e-12)
+
+
+def test_fused_eig(mf, dm):
+    t_dm = batch_dm(dm)
+    fused = t_make_eig_fused(t_dm, mf._t_proj_bra, mf._shell_sec)
+    shells = t_make_eig(t_dm, dense_ovlp_shells(mf))
+    assert fused.shape == shells.shape
+    assert torch.allclose(fused, shells, atol=1e-12)
+    # single dm goes through the cached projection
+    assert torch.allclose(torch.from_numpy(mf.make_eig(dm)), shells[0], atol=1e-12)
+
+
+def test_ovlp_shells_views(mf):
+    for ov, ref in zip(mf._t_ovlp_shells, dense_ovlp_shells(mf)):
+        assert torch.equal(ov, ref)
@@ -0,0 +1,64 @@
+import pytest
+import torch
+from deepks.scf.scf import DSCF
+from deepks.scf.grad import t_make_grad_e_pdm, t_make_grad_pdm_x, t_grad_corr
+
+
+def loop_grad_pdm_x(mol, dm, ovlp_shells, ipov_shells):
+    """t_make_grad_pdm_x with an explicit loop over atoms"""
+    ralst = [ii for ii in range(mol.natm) if not mol.elements[ii].startswith("X")]
+    gdmx_shells = [torch.zeros([mol.natm, 3, len(ralst), ss, ss], dtype=float)
+                        for ss in [ov.shape[-1] for ov in ovlp_shells]]
+    for gdmx, govx, ovlp in zip(gdmx_shells, ipov_shells, ovlp_shells):
+        gproj = torch.einsum('xrap,rs,saq->xapq', govx, dm, ovlp)
+        for ira, ia in enumerate(ralst):
+            bg, ed = mol.aoslice_by_atom()[ia, 2:]
+            gdmx[ia] -= torch.einsum('xrap,rs,saq->xapq', govx[:,bg:ed], dm[bg:ed], ovlp)
+            gdmx[ia,:,ira] += gproj[:, ira]
+        gdmx += gdmx.clone().transpose(-1,-2)
+    return gdmx_shells
+
+
+def loop_grad_corr(mol, model, dm, ovlp_shells, ipov_shells, atmlst):
+    """t_grad_corr with an explicit loop over atoms"""
+    ralst = [ii for ii in range(mol.natm) if not mol.elements[ii].startswith("X")]
+    dec = torch.zeros([len(atmlst), 3], dtype=float)
+    gedm_shells = t_make_grad_e_pdm(model, dm, ovlp_shells)
+    for gedm, govx, ovlp in zip(gedm_shells, ipov_shells, ovlp_shells):
+        ginner = torch.einsum('xrap,rs,saq->xapq', govx, dm, ovlp) * 2
+        gouter = -torch.einsum('xrap,apq,saq->xrs', govx, gedm, ovlp) * 2
+        for k, ia in enumerate(atmlst):
+            if ia not in ralst:
+                continue
+            bg, ed = mol.aoslice_by_atom()[ia, 2:]
+            ira = ralst.index(ia)
+            dec[k] += torch.einsum('xpq,pq->x', ginner[:,ira], gedm[ira])
+            dec[k] += torch.einsum('xrs,rs->x', gouter[:,bg:ed], dm[bg:ed])
+    return dec
+
+
+@pytest.fixture(params=["plain", "ghost"])
+def case(request, mol, dm, ghost_mol, ghost_dm, model):
+    if request.param == "ghost":
+        mol, dm = ghost_mol, ghost_dm
+    grad = DSCF(mol, model).nuc_grad_method()
+    return mol, torch.from_numpy(dm).double(), grad
+
+
+def test_grad_pdm_x(case):
+    mol, t_dm, grad = case
+    args = (mol, t_dm, grad._t_ovlp_shells, grad._t_ipov_shells)
+    for gv, gl in zip(t_make_grad_pdm_x(*args), loop_grad_pdm_x(*args)):
+        assert gv.shape == gl.shape
+        assert torch.allclose(gv, gl, atol=1e-12)
+
+
+@pytest.mark.parametrize("atmlst", [None, [2, 0]])
+def test_grad_corr(case, model, atmlst):
+    mol, t_dm, grad = case
+    args = (mol, model, t_dm, grad._t_ovlp_shells, grad._t_ipov_shells)
+    ref = loop_grad_corr(*args, atmlst=range(mol.natm) if atmlst is None else atmlst)
+    assert torch.allclose(t_grad_corr(*args, atmlst=atmlst), ref, atol=1e-12)
+    # the gradient method reuses the closed form dE / dD of the scf object
+    assert torch.allclose(torch.from_numpy(grad.grad_corr(t_dm.numpy(), atmlst)),
+                          ref, atol=1e-10)
@@ -0,0 +1,43 @@
+import pytest
+import numpy as np
+from pyscf import gto, scf
+from deepks.scf.scf import DSCF
+from conftest import H2O
+
+# two waters far apart, so that screening drops ao blocks of the other one
+H2O_DIMER = H2O + "; O 9 0 0; H 9 0.75 0.6; H 9 -0.76 0.59"
+
+
+def compare_screened(mol, model, dm, screen_tol, atol):
+    dense = DSCF(mol, model)
+    screened = DSCF(mol, model, screen_tol=screen_tol)
+    for p0, p1 in zip(dense.make_pdm(dm), screened.make_pdm(dm)):
+        assert np.allclose(p0, p1, atol=atol)
+    # batched dm goes through the non cached path
+    assert np.allclose(dense.make_eig(np.stack([dm, dm])),
+                       screened.make_eig(np.stack([dm, dm])), atol=atol)
+    ec0, vc0 = dense.get_corr(dm)
+    ec1, vc1 = screened.get_corr(dm)
+    assert ec1 == pytest.approx(ec0, abs=atol)
+    assert np.allclose(vc0, vc1, atol=atol)
+    g0, g1 = dense.nuc_grad_method(), screened.nuc_grad_method()
+    assert np.allclose(g0.grad_corr(dm), g1.grad_corr(dm), atol=atol)
+    assert np.allclose(g0.make_grad_eig_x(dm), g1.make_grad_eig_x(dm), atol=atol)
+    return screened
+
+
+def test_screen_tol_zero(mol, dm, model):
+    screened = compare_screened(mol, model, dm, 1e-30, atol=1e-12)
+    assert screened._t_ao_mask.all()
+
+
+def test_screen_ghost(ghost_mol, ghost_dm, model):
+    compare_screened(ghost_mol, model, ghost_dm, 1e-30, atol=1e-12)
+
+
+def test_screen_dimer(model):
+    mol = gto.M(atom=H2O_DIMER, basis="sto-3g", verbose=0)
+    dm = scf.RHF(mol).run().make_rdm1()
+    screened = compare_screened(mol, model, dm, 1e-8, atol=1e-6)
+    # each projected atom only keeps ao of its own water
+    assert screened._t_ao_mask.sum(-1).max() < mol.nao
@@ -0,0 +1,72 @@
+import pytest
+import torch
+import numpy as np
+from deepks.model.model import CorrNet
+from deepks.scf.scf import DSCF
+from conftest import make_model
+
+CASES = [
+    dict(hidden_sizes=(8, 8)),
+    dict(hidden_sizes=(8, 8), embedding="trace"),
+    dict(hidden_sizes=(), embedding="trace"),
+    dict(hidden_sizes=(8,), embedding="thermal", actv_fn="tanh"),
+    dict(hidden_sizes=(8, 8), embedding=dict(type="thermal", embd_sizes=3)),
+    dict(hidden_sizes=(4, 4), actv_fn="mygelu", use_resnet=False),
+]
+
+
+def decorate(model):
+    """set every folded part of the model to something non trivial"""
+    gen = np.random.default_rng(1)
+    nd = model.input_dim
+    model.set_normalization(gen.normal(size=nd), gen.uniform(0.5, 1.5, size=nd))
+    model.set_prefitting(gen.normal(size=nd), gen.normal(size=1))
+    model.output_scale.data.fill_(3.)
+    model.set_energy_const(0.3)
+    embd = model.embedder
+    if embd is not None and hasattr(embd, "running_mean"):
+        embd.running_mean.data.uniform_()
+        embd.running_var.data.uniform_(0.5, 1.5)
+    return model
+
+
+def energy_and_grad(model, x, mask=None):
+    x = x.clone().requires_grad_(True)
+    e = model(x, mask)
+    [g] = torch.autograd.grad(e.sum(), x)
+    return e.detach(), g
+
+
+@pytest.fixture(params=range(len(CASES)))
+def models(request):
+    model = decorate(make_model(**CASES[request.param]))
+    return model, model.compile(check=False)
+
+
+def test_scripted_outputs(models, mf, dm):
+    model, smodel = models
+    # descriptors of water, several frames by scaling dm, plus random noise
+    eig = torch.from_numpy(np.stack([mf.make_eig(dm * s) for s in (1, 0.9, 1.1)]))
+    x = eig + 0.1 * torch.randn(eig.shape, dtype=torch.float64)
+    mask = torch.ones(x.shape[:2], dtype=bool)
+    mask[1:, -1] = False
+    for args in [(x,), (x, mask), (x[0],)]:
+        e0, g0 = energy_and_grad(model, *args)
+        e1, g1 = energy_and_grad(smodel, *args)
+        assert e1.shape == e0.shape
+        assert torch.allclose(e0, e1, rtol=1e-10, atol=1e-10)
+        assert torch.allclose(g0, g1, rtol=1e-10, atol=1e-10)
+
+
+def test_scripted_file(tmp_path, mol, dm):
+    model = decorate(make_model(embedding="thermal", elem_table=([1, 8], [0.5, -1.2])))
+    fname = str(tmp_path / "model.ptg")
+    model.compile_save(fname)
+    smodel = CorrNet.load(fname)
+    assert smodel.get_elem_const([1, 1, 8]) == pytest.approx(-0.2)
+    assert smodel._pbas == model._pbas
+    # scf with the exported model gives the same energy and potential
+    ec0, vc0 = DSCF(mol, model).get_corr(dm)
+    ec1, vc1 = DSCF(mol, fname).get_corr(dm)
+    assert ec1 == pytest.approx(ec0, abs=1e-10)
+    assert np.allclose(vc0, vc1, atol=1e-10)